@@ -1,6 +1,6 @@
+from contextlib import asynccontextmanager
 from fastapi import FastAPI
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.staticfiles import StaticFiles
 import os
 import uvicorn
 from dotenv import load_dotenv
@@ -11,15 +11,36 @@ from generate_image import router as generate_image_router
 from files import router as files_router
 from settings import router as settings_router
 from session import router as session_router
+from session_store import router as session_store_router, close_session_store
 from tokenizer import router as tokenizer_router
 from model import router as model_router
+from http_client import open_clients, close_clients
+from context_cache import close_context_caches
+from token_cache import close_token_cache
+from session_index import close_session_index
+from character_index import close_character_index
+from static_files import DataFiles
 
 os.environ["TF_ENABLE_ONEDNN_OPTS"] = "0"
 # os.environ['TF_CPP_MIN_LOG_LEVEL'] = '2'  # hide tensorflow warnings
 load_dotenv()
 
-app = FastAPI()
-app.mount("/data", StaticFiles(directory="../data"), name="data")
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    await open_clients()
+    yield
+    await close_session_store()
+    await close_context_caches()
+    await close_clients()
+    close_token_cache()
+    close_session_index()
+    close_character_index()
+
+
+app = FastAPI(lifespan=lifespan)
+app.mount("/data", DataFiles(directory="../data"), name="data")
 
 # CORS Configuration
 app.add_middleware(
@@ -37,6 +58,7 @@ app.include_router(characters_router)
 app.include_router(files_router)
 app.include_router(settings_router)
 app.include_router(session_router)
+app.include_router(session_store_router)
 app.include_router(tokenizer_router)
 app.include_router(model_router)
 
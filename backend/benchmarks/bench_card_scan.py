@@ -0,0 +1,99 @@
+"""Character card parsing: pypng chunk reader versus the early-exit chunk scanner.
+
+Writes synthetic cards (random IDAT payload, a chara chunk before the image
+data and a ccv3 chunk after it, like SillyTavern exports) to a temporary
+directory and reads their info with each reader:
+
+    python benchmarks/bench_card_scan.py [cards] [megabytes per card]
+
+Exits with status 1 if the readers disagree or the scanner is not faster.
+"""
+
+import base64
+import json
+import os
+import struct
+import sys
+import tempfile
+import time
+import zlib
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+import png  # noqa: E402
+from card import PNG_SIGNATURE, decode_card_text, read_card_info, read_cards_info  # noqa: E402
+
+IDAT_CHUNK_SIZE = 65536
+
+
+def chunk(chunk_type: bytes, data: bytes) -> bytes:
+    return struct.pack(">I", len(data)) + chunk_type + data + struct.pack(">I", zlib.crc32(data, zlib.crc32(chunk_type)))
+
+
+def text_chunk(key: str, info: dict) -> bytes:
+    return chunk(b"tEXt", key.encode("latin-1") + b"\0" + base64.b64encode(json.dumps(info).encode()))
+
+
+def make_card(index: int, idat: list[bytes]) -> bytes:
+    info = {"name": f"Character {index}", "description": "A synthetic card. " * 200, "personality": "", "scenario": ""}
+    return b"".join(
+        [
+            PNG_SIGNATURE,
+            chunk(b"IHDR", struct.pack(">IIBBBBB", 832, 1216, 8, 2, 0, 0, 0)),
+            text_chunk("chara", {**info, "spec": "chara"}),
+            *idat,
+            text_chunk("ccv3", info),
+            chunk(b"IEND", b""),
+        ]
+    )
+
+
+def read_card_info_pypng(path: str) -> dict:
+    """The reader used before the scanner: every chunk read and CRC-checked by pypng."""
+    info = {}
+    with open(path, "rb") as f:
+        for chunk_type, chunk_data in list(png.Reader(file=f).chunks()):
+            if chunk_type == b"tEXt":
+                key, value = decode_card_text(chunk_data)
+                if value is None:
+                    continue
+                info = value
+                if key == "ccv3":
+                    break
+    return info
+
+
+def timed(label: str, read, paths: list[str]) -> tuple[float, list]:
+    start = time.perf_counter()
+    infos = read(paths)
+    elapsed = time.perf_counter() - start
+    print(f"{label:24} {elapsed * 1000:10.1f} ms {elapsed / len(paths) * 1e6:10.1f} us/card")
+    return elapsed, infos
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 500
+    size = int(float(sys.argv[2]) * 1024 * 1024) if len(sys.argv) > 2 else 2 * 1024 * 1024
+    payload = os.urandom(size)
+    idat = [chunk(b"IDAT", payload[i : i + IDAT_CHUNK_SIZE]) for i in range(0, size, IDAT_CHUNK_SIZE)]
+
+    with tempfile.TemporaryDirectory() as directory:
+        paths = []
+        for i in range(count):
+            path = os.path.join(directory, f"card{i}.png")
+            with open(path, "wb") as f:
+                f.write(make_card(i, idat))
+            paths.append(path)
+        print(f"{count} cards of {os.path.getsize(paths[0]) / 1024 / 1024:.1f} MB, page cache warm")
+
+        pypng_time, expected = timed("pypng", lambda paths: [read_card_info_pypng(path) for path in paths], paths)
+        scan_time, scanned = timed("scanner", lambda paths: [read_card_info(path) for path in paths], paths)
+        pool_time, pooled = timed("scanner, thread pool", read_cards_info, paths)
+
+    print(f"{'speedup':24} {pypng_time / scan_time:10.1f}x {pypng_time / pool_time:10.1f}x with the pool")
+    if scanned != expected or pooled != expected or scan_time >= pypng_time:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,86 @@
+"""Bytes sent to Google AI Studio with and without the context cache.
+
+Plays a chat session against a mock Gemini endpoint and adds up the request
+bodies, including the cachedContents calls made by the cached path:
+
+    python benchmarks/bench_context_cache.py [turns]
+
+Exits with status 1 if the cached path does not send fewer bytes.
+"""
+
+import asyncio
+import json
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+import httpx  # noqa: E402
+import http_client  # noqa: E402
+from context_cache import apply_gemini_context_cache, close_context_caches  # noqa: E402
+
+MODEL = "gemini-2.0-flash-thinking-exp-01-21"
+SESSION_ID = "Benchmark/2025-01-01 00-00-00"
+
+
+class MockGemini:
+    def __init__(self):
+        self.sent = {"generate": 0, "cachedContents": 0}
+        self.caches = 0
+
+    def __call__(self, request: httpx.Request) -> httpx.Response:
+        if "cachedContents" in request.url.path:
+            self.sent["cachedContents"] += len(request.content)
+            if request.method == "POST":
+                self.caches += 1
+                return httpx.Response(200, json={"name": f"cachedContents/{self.caches}"})
+            return httpx.Response(200, json={})
+        self.sent["generate"] += len(request.content)
+        chunk = {"candidates": [{"content": {"parts": [{"text": "ok"}], "role": "model"}}]}
+        return httpx.Response(200, content=f"data: {json.dumps(chunk)}\r\n\r\n".encode())
+
+
+def make_payload(turns: int) -> dict:
+    system = "You are the narrator of an interactive story. " * 600
+    contents = []
+    for i in range(turns):
+        role = "user" if i % 2 else "model"
+        contents.append({"role": role, "parts": [{"text": f"Message {i}: " + "Something happens in the story. " * 20}]})
+    return {
+        "contents": contents,
+        "systemInstruction": {"parts": [{"text": system}]},
+        "generationConfig": {"candidateCount": 1, "maxOutputTokens": 512},
+    }
+
+
+async def play(turns: int, enabled: bool) -> MockGemini:
+    mock = MockGemini()
+    http_client._clients[http_client.GOOGLEAISTUDIO_URL] = httpx.AsyncClient(transport=httpx.MockTransport(mock))
+    settings = {"context_cache": {"enabled": enabled}}
+    url = f"{http_client.GOOGLEAISTUDIO_URL}/v1beta/models/{MODEL}:streamGenerateContent?alt=sse&key=benchmark"
+    for turn in range(1, turns + 1):
+        payload = await apply_gemini_context_cache(SESSION_ID, MODEL, "benchmark", make_payload(turn * 2), settings)
+        async with http_client.get_client(url).stream("POST", url, json=payload) as response:
+            await response.aread()
+    await close_context_caches()
+    return mock
+
+
+async def main():
+    turns = int(sys.argv[1]) if len(sys.argv) > 1 else 40
+    plain = await play(turns, False)
+    cached = await play(turns, True)
+    plain_total = sum(plain.sent.values())
+    cached_total = sum(cached.sent.values())
+    print(f"{'uncached':10} {plain_total:12,} bytes")
+    print(
+        f"{'cached':10} {cached_total:12,} bytes "
+        f"({cached.sent['cachedContents']:,} in cachedContents calls, {cached.caches} caches created)"
+    )
+    print(f"{'saved':10} {1 - cached_total / plain_total:12.1%}")
+    if cached_total >= plain_total:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
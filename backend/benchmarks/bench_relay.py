@@ -0,0 +1,92 @@
+"""Relay throughput micro-benchmark.
+
+Replays a recorded upstream SSE stream through stream_post and measures how
+fast the relay turns it into client frames:
+
+    python benchmarks/bench_relay.py [recorded_stream.txt]
+
+Without a recording, a synthetic OpenAI chat completion stream is used.
+"""
+
+import asyncio
+import json
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+import httpx  # noqa: E402
+import http_client  # noqa: E402
+import stream_post as relay_module  # noqa: E402
+from stream_post import stream_post  # noqa: E402
+
+URL = "http://relay-benchmark/v1/chat/completions"
+
+
+def synthetic_stream(tokens: int = 20000) -> bytes:
+    words = ["The", " quick", " brown", " fox", " jumps", " over", " the", " lazy", " dog", ".\n"]
+    lines = []
+    for i in range(tokens):
+        chunk = {"id": "chatcmpl-1", "object": "chat.completion.chunk", "choices": [{"index": 0, "delta": {"content": words[i % len(words)]}}]}
+        lines.append(f"data: {json.dumps(chunk)}\n\n")
+    lines.append("data: [DONE]\n\n")
+    return "".join(lines).encode()
+
+
+def install_client(body: bytes):
+    transport = httpx.MockTransport(lambda request: httpx.Response(200, content=body))
+    http_client._clients[http_client.base_url_of(URL)] = httpx.AsyncClient(transport=transport)
+
+
+async def legacy_relay(body: bytes) -> int:
+    """The per-token relay stream_post used before: json.loads, json.dumps and an f-string."""
+    frames = 0
+    async with http_client.get_client(URL).stream("POST", URL, json={}) as response:
+        async for line in response.aiter_lines():
+            if line.startswith("data: "):
+                data = line[6:]
+                if data == "[DONE]":
+                    break
+                json_data = json.loads(data)
+                text = json_data["choices"][0].get("delta", {}).get("content")
+                if text:
+                    frame = f"data: {json.dumps({'text': text})}\n\n"
+                    frames += bool(frame)
+    return frames
+
+
+async def fast_relay(frame_ms: float) -> int:
+    relay_module.load_settings = lambda: {"relay": {"frame_ms": frame_ms}}
+    response = await stream_post(URL, None, {})
+    frames = 0
+    async for _ in response.body_iterator:
+        frames += 1
+    return frames
+
+
+async def measure(name: str, run, tokens: int, repeat: int = 5):
+    best = float("inf")
+    frames = 0
+    for _ in range(repeat):
+        start = time.perf_counter()
+        frames = await run()
+        best = min(best, time.perf_counter() - start)
+    print(f"{name:28} {tokens / best:12,.0f} tokens/s {frames:8} frames")
+
+
+async def main():
+    if len(sys.argv) > 1:
+        with open(sys.argv[1], "rb") as f:
+            body = f.read()
+    else:
+        body = synthetic_stream()
+    tokens = body.count(b"data: ") - 1
+    install_client(body)
+    await measure("legacy relay", lambda: legacy_relay(body), tokens)
+    await measure("fast relay, no coalescing", lambda: fast_relay(0), tokens)
+    await measure("fast relay, 15 ms frames", lambda: fast_relay(15), tokens)
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
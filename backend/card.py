@@ -0,0 +1,162 @@
+import base64
+import json
+import os
+import struct
+import tempfile
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+
+PNG_SIGNATURE = b'\x89PNG\r\n\x1a\n'
+# Cards read at once when parsing many files, reads release the GIL
+MAX_CARD_READERS = 8
+# Chunk payloads are copied in blocks of this size when a card is rewritten
+COPY_BLOCK_SIZE = 1024 * 1024
+
+
+def decode_card_text(chunk_data: bytes) -> tuple[str, dict | None]:
+    """Key and character info of a tEXt chunk, info is None if it does not hold a card."""
+    # tEXt chunks are separated by null bytes between key and value
+    key, value = chunk_data.split(b'\0', 1)
+    key = key.decode('latin-1')
+    if key not in ('ccv3', 'chara'):
+        return key, None
+    try:
+        decoded = base64.b64decode(value).decode('utf-8')
+        return key, json.loads(decoded)
+    except json.JSONDecodeError as e:
+        print(f"JSON decode error: {e}")
+    except Exception as e:
+        print(f"Error decoding {key}: {e}")
+    return key, None
+
+
+def iter_text_chunks(f):
+    """Yield the data of the tEXt chunks of a PNG file, without reading other chunks.
+
+    Only chunk headers are read, the payload of IDAT and other chunks is
+    seeked past. Stops at IEND. tEXt chunks are CRC-checked.
+    """
+    if f.read(8) != PNG_SIGNATURE:
+        raise ValueError("PNG file has invalid signature")
+    while True:
+        header = f.read(8)
+        if len(header) < 8:
+            raise ValueError("PNG file ends before IEND")
+        length, chunk_type = struct.unpack('>I4s', header)
+        if chunk_type == b'IEND':
+            return
+        if chunk_type != b'tEXt':
+            f.seek(length + 4, 1)
+            continue
+        data = f.read(length)
+        crc = f.read(4)
+        if len(crc) < 4:
+            raise ValueError("PNG file ends in a tEXt chunk")
+        if struct.unpack('>I', crc)[0] != zlib.crc32(data, zlib.crc32(chunk_type)):
+            raise ValueError("tEXt chunk has a bad CRC")
+        yield data
+
+
+def read_card_info(path: str) -> dict:
+    """Character info of a card, from its ccv3 chunk or else its chara chunk.
+
+    Reading stops at the ccv3 chunk, a card without one is read up to IEND.
+    """
+    info = {}
+    with open(path, 'rb') as f:
+        for chunk_data in iter_text_chunks(f):
+            key, value = decode_card_text(chunk_data)
+            if value is None:
+                continue
+            info = value
+            if key == 'ccv3':
+                break
+    return info
+
+
+def read_cards_info(paths: list[str]) -> list[dict | Exception]:
+    """read_card_info of many cards on a thread pool, with the error for cards that could not be read."""
+
+    def read(path: str) -> dict | Exception:
+        try:
+            return read_card_info(path)
+        except Exception as e:
+            return e
+
+    if len(paths) <= 1:
+        return [read(path) for path in paths]
+    with ThreadPoolExecutor(max_workers=min(MAX_CARD_READERS, len(paths))) as executor:
+        return list(executor.map(read, paths))
+
+
+def encode_card_chunk(key: str, info: dict) -> bytes:
+    """A complete tEXt chunk holding info under key, with its length and CRC."""
+    data = key.encode('latin-1') + b'\0' + base64.b64encode(json.dumps(info).encode())
+    return struct.pack('>I', len(data)) + b'tEXt' + data + struct.pack('>I', zlib.crc32(data, zlib.crc32(b'tEXt')))
+
+
+def copy_bytes(src, dst, length: int):
+    while length > 0:
+        block = src.read(min(length, COPY_BLOCK_SIZE))
+        if not block:
+            raise ValueError("PNG file ends in a chunk")
+        dst.write(block)
+        length -= len(block)
+
+
+def copy_card(src, dst, info: dict):
+    """Copy a PNG from src to dst chunk by chunk, with info as its card data.
+
+    The ccv3 chunk is written right after IHDR, so readers find it before
+    the image data, and older ccv3 chunks are dropped. The first chara
+    chunk is rewritten where it is, later ones are dropped, so cards do not
+    grow on every save. Other chunks are copied without being decoded.
+    """
+    if src.read(8) != PNG_SIGNATURE:
+        raise ValueError("PNG file has invalid signature")
+    dst.write(PNG_SIGNATURE)
+    chara_written = False
+    while True:
+        header = src.read(8)
+        if len(header) < 8:
+            raise ValueError("PNG file ends before IEND")
+        length, chunk_type = struct.unpack('>I4s', header)
+        if chunk_type == b'tEXt':
+            chunk = src.read(length + 4)
+            if len(chunk) < length + 4:
+                raise ValueError("PNG file ends in a tEXt chunk")
+            key = chunk.split(b'\0', 1)[0]
+            if key == b'chara' and not chara_written:
+                dst.write(encode_card_chunk('chara', info))
+                chara_written = True
+            elif key not in (b'ccv3', b'chara'):
+                dst.write(header + chunk)
+            continue
+        dst.write(header)
+        copy_bytes(src, dst, length + 4)
+        if chunk_type == b'IHDR':
+            dst.write(encode_card_chunk('ccv3', info))
+        elif chunk_type == b'IEND':
+            return
+
+
+def write_card(path: str, info: dict, image=None):
+    """Write a card with new info, over the image it already has unless image is given.
+
+    image is a binary file object holding a PNG. The card goes to a
+    temporary file in the same directory that is renamed over path, so an
+    interrupted save leaves the previous card.
+    """
+    directory = os.path.dirname(path)
+    fd, tmp_path = tempfile.mkstemp(dir=directory, prefix='.card-', suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as dst:
+            if image is None:
+                with open(path, 'rb') as src:
+                    copy_card(src, dst, info)
+            else:
+                copy_card(image, dst, info)
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
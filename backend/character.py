@@ -1,11 +1,16 @@
 # list character cards
-import os
+import asyncio
 import base64
+import io
 import json
-from fastapi import APIRouter, HTTPException
+import os
+from fastapi import APIRouter, HTTPException, Query, Request
+from starlette.datastructures import UploadFile
 from settings import get_data_path
-import png
 from pydantic import BaseModel
+from card import write_card
+from upload import MAX_UPLOAD_SIZE, hash_file, read_form
+from character_index import query_characters, refresh_character_index
 
 router = APIRouter()
 
@@ -16,86 +21,90 @@ class Character(BaseModel):
 
 
 @router.get('/api/characters')
-async def list_characters():
-    """List all character PNG files in the data/characters directory.
-    
+async def list_characters(search: str = '', offset: int = 0, limit: int = Query(100, ge=1, le=1000)):
+    """List the character cards in the data/characters directory.
+
+    Cards are read from the character index, only new and changed files are
+    parsed. Images are not included: "image" and "thumbnail" are paths
+    under /data, loaded by the client when shown.
+
     Returns:
-        List[dict]: List of dictionaries containing character information.
-              Each dictionary has 'id' and 'image' keys
+        dict: 'characters' with 'file_name', 'image', 'thumbnail' and 'info'
+              keys, and 'total', the number of cards matching the search
     """
-    characters_dir = get_data_path('characters')
-    
     try:
-        # Ensure the directory exists
-        if not os.path.exists(characters_dir):
-            os.makedirs(characters_dir)
-        
-        # Get all PNG files
-        characters = []
-        for filename in os.listdir(characters_dir):
-            if filename.lower().endswith('.png'):
-                character_id = os.path.splitext(filename)[0]
-                image_path = os.path.join(characters_dir, filename)
-                
-                # Read and encode the image
-                with open(image_path, 'rb') as img_file:
-                    png_reader = png.Reader(file=img_file)
-                    chunks = list(png_reader.chunks())
-                    
-                    # Find metadata in tEXt chunks
-                    info = {}
-                    for chunk_type, chunk_data in chunks:
-                        if chunk_type == b'tEXt':
-                            # tEXt chunks are separated by null bytes between key and value
-                            key, value = chunk_data.split(b'\0', 1)
-                            key = key.decode('latin-1')
-                            value = value.decode('utf-8')
-                            
-                            try:
-                                if key == 'ccv3':
-                                    decoded = base64.b64decode(value).decode('utf-8')
-                                    info = json.loads(decoded)
-                                    break
-                                if key == 'chara':
-                                    decoded = base64.b64decode(value).decode('utf-8')
-                                    info = json.loads(decoded)
-                            except json.JSONDecodeError as e:
-                                print(f"JSON decode error: {e}")
-                            except Exception as e:
-                                print(f"Error decoding {key}: {e}")
-                    
-                    # Reset the file pointer to the beginning
-                    img_file.seek(0)
-                    image_data = base64.b64encode(img_file.read()).decode()
-                
-                    if info.get('name') is not None:
-                        characters.append({
-                            'file_name': character_id,
-                            'image': f'data:image/png;base64,{image_data}',
-                            'info': info
-                        })
-        
-        return sorted(characters, key=lambda x: x['file_name'])
+        await asyncio.to_thread(refresh_character_index)
+        characters, total = await asyncio.to_thread(query_characters, search, max(offset, 0), limit)
+        return {"characters": characters, "total": total, "offset": offset, "limit": limit}
     except Exception as e:
         print(f"Error listing characters: {e}")
         raise HTTPException(status_code=500, detail=str(e))
 
 
-def generate_text_chunk_tuple(key: str, value: Character):
-    info_base64 = base64.b64encode(json.dumps(value.info).encode()).decode()
-    text = f"{key}\0{info_base64}"
-    return tuple([b'tEXt', text.encode()])
-
 @router.post('/api/save-char')
 async def save_char(data: Character):
     path = get_data_path(f'characters/{data.file_name}.png')
-    
-    binary_data = base64.b64decode(data.image)
-    reader = png.Reader(bytes=binary_data)
-    chunks = list(reader.chunks())
-    insert_pos = 1  # IHDR is always the first chunk
-    text_chunk = generate_text_chunk_tuple('ccv3', data)
-    chunks.insert(insert_pos, text_chunk)
-    with open(path, 'wb') as f:
-        png.write_chunks(f, chunks)
-    return {"success": True}
\ No newline at end of file
+    image = io.BytesIO(base64.b64decode(data.image))
+    try:
+        await asyncio.to_thread(write_card, path, data.info, image)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=f"Invalid card image: {e}")
+    return {"success": True}
+
+
+@router.post('/api/upload/char')
+async def upload_char(request: Request):
+    """save-char as a multipart form: file_name, info as JSON and the PNG in a "file" part."""
+    form = await read_form(request)
+    try:
+        return await save_char_form(form)
+    finally:
+        await form.close()
+
+
+async def save_char_form(form) -> dict:
+    upload = form.get('file')
+    if not isinstance(upload, UploadFile) or not isinstance(form.get('file_name'), str):
+        raise HTTPException(status_code=400, detail='Multipart upload needs file_name, info and a "file" part')
+    if upload.size is not None and upload.size > MAX_UPLOAD_SIZE:
+        raise HTTPException(status_code=413, detail=f"Upload larger than {MAX_UPLOAD_SIZE} bytes")
+    try:
+        info = json.loads(form.get('info') or '{}')
+    except json.JSONDecodeError as e:
+        raise HTTPException(status_code=400, detail=f"Invalid info: {e}")
+    path = get_data_path(f"characters/{form['file_name']}.png")
+    try:
+        result = await asyncio.to_thread(hash_file, upload.file)
+        await asyncio.to_thread(write_card, path, info, upload.file)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=f"Invalid card image: {e}")
+    return {"success": True, **result}
+
+
+class CharacterInfo(BaseModel):
+    file_name: str
+    info: dict
+    # Card whose image is kept when it is saved under a new file name
+    source_file_name: str | None = None
+
+
+def copy_char(source_path: str, path: str, info: dict):
+    if source_path == path:
+        write_card(path, info)
+    else:
+        with open(source_path, 'rb') as image:
+            write_card(path, info, image)
+
+
+@router.post('/api/save-char-info')
+async def save_char_info(data: CharacterInfo):
+    """Save the info of a card, keeping the image already on disk."""
+    path = get_data_path(f'characters/{data.file_name}.png')
+    source_path = get_data_path(f'characters/{data.source_file_name or data.file_name}.png')
+    if not os.path.exists(source_path):
+        raise HTTPException(status_code=404, detail=f"Character not found: {data.source_file_name or data.file_name}")
+    try:
+        await asyncio.to_thread(copy_char, source_path, path, data.info)
+    except ValueError as e:
+        raise HTTPException(status_code=500, detail=f"Invalid card on disk: {e}")
+    return {"success": True}
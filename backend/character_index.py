@@ -0,0 +1,134 @@
+import json
+import os
+import sqlite3
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from PIL import Image
+from settings import get_data_path
+from card import MAX_CARD_READERS, read_cards_info
+
+# Parsed card info keyed by file name, reparsed when the file's size or mtime changes
+_connection = None
+_lock = threading.Lock()
+
+# Thumbnails are scaled down to fit this box, cards are usually portrait
+THUMBNAIL_SIZE = (320, 480)
+THUMBNAIL_QUALITY = 80
+
+
+def get_connection() -> sqlite3.Connection:
+    global _connection
+    if _connection is None:
+        _connection = sqlite3.connect(get_data_path("character_index.db"), check_same_thread=False)
+        _connection.executescript(
+            "CREATE TABLE IF NOT EXISTS characters ("
+            "file_name TEXT PRIMARY KEY, size INTEGER NOT NULL, mtime_ns INTEGER NOT NULL, "
+            "name TEXT, info TEXT NOT NULL, thumbnail INTEGER NOT NULL);"
+            "CREATE INDEX IF NOT EXISTS characters_by_name ON characters (name COLLATE NOCASE);"
+        )
+        _connection.commit()
+    return _connection
+
+
+def thumbnail_path(file_name: str) -> str:
+    """Path relative to the data directory, served by the /data mount."""
+    return f"thumbnails/characters/{file_name}.webp"
+
+
+def make_thumbnail(image_path: str, file_name: str) -> bool:
+    path = get_data_path(thumbnail_path(file_name))
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    try:
+        with Image.open(image_path) as image:
+            image.thumbnail(THUMBNAIL_SIZE)
+            image.save(path, "WEBP", quality=THUMBNAIL_QUALITY)
+        return True
+    except OSError as e:
+        print(f"Error making thumbnail of {file_name}: {e}")
+        return False
+
+
+def remove_thumbnail(file_name: str):
+    try:
+        os.remove(get_data_path(thumbnail_path(file_name)))
+    except FileNotFoundError:
+        pass
+
+
+def refresh_character_index():
+    """Bring the index up to date with data/characters, parsing new and changed cards only."""
+    characters_dir = get_data_path("characters")
+    os.makedirs(characters_dir, exist_ok=True)
+    files = {}
+    with os.scandir(characters_dir) as entries:
+        for entry in entries:
+            if entry.is_file() and entry.name.lower().endswith(".png"):
+                stat = entry.stat()
+                files[os.path.splitext(entry.name)[0]] = (entry.path, stat.st_size, stat.st_mtime_ns)
+    with _lock:
+        indexed = {
+            file_name: (size, mtime_ns)
+            for file_name, size, mtime_ns in get_connection().execute("SELECT file_name, size, mtime_ns FROM characters")
+        }
+
+    removed = [file_name for file_name in indexed if file_name not in files]
+    changed = [(file_name, *file) for file_name, file in files.items() if indexed.get(file_name) != file[1:]]
+    infos = read_cards_info([path for _, path, _, _ in changed])
+    for (file_name, _, _, _), info in zip(changed, infos):
+        if isinstance(info, Exception):
+            print(f"Error reading card {file_name}: {info}")
+    infos = [info if isinstance(info, dict) else {} for info in infos]
+    with ThreadPoolExecutor(max_workers=MAX_CARD_READERS) as executor:
+        thumbnails = list(
+            executor.map(
+                lambda card: make_thumbnail(card[0][1], card[0][0]) if card[1].get("name") is not None else False,
+                zip(changed, infos),
+            )
+        )
+    rows = [
+        (file_name, size, mtime_ns, info.get("name"), json.dumps(info), thumbnail)
+        for (file_name, _, size, mtime_ns), info, thumbnail in zip(changed, infos, thumbnails)
+    ]
+
+    if not removed and not rows:
+        return
+    with _lock:
+        connection = get_connection()
+        connection.executemany("DELETE FROM characters WHERE file_name = ?", [(file_name,) for file_name in removed])
+        connection.executemany("INSERT OR REPLACE INTO characters VALUES (?, ?, ?, ?, ?, ?)", rows)
+        connection.commit()
+    for file_name in removed:
+        remove_thumbnail(file_name)
+    print(f"Character index: {len(rows)} cards parsed, {len(removed)} removed")
+
+
+def query_characters(search: str = "", offset: int = 0, limit: int = 100) -> tuple[list[dict], int]:
+    """Cards with a name, sorted by file name, filtered by a case-insensitive name search."""
+    pattern = "%" + search.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_") + "%"
+    where = "WHERE name IS NOT NULL AND name LIKE ? ESCAPE '\\'"
+    with _lock:
+        connection = get_connection()
+        rows = connection.execute(
+            f"SELECT file_name, mtime_ns, info, thumbnail FROM characters {where} ORDER BY file_name LIMIT ? OFFSET ?",
+            (pattern, limit, offset),
+        ).fetchall()
+        (total,) = connection.execute(f"SELECT COUNT(*) FROM characters {where}", (pattern,)).fetchone()
+    characters = [
+        {
+            "file_name": file_name,
+            # The version makes browsers fetch a card again once it is saved
+            "image": f"characters/{file_name}.png?v={mtime_ns}",
+            "thumbnail": f"{thumbnail_path(file_name)}?v={mtime_ns}" if thumbnail else None,
+            "info": json.loads(info),
+        }
+        for file_name, mtime_ns, info, thumbnail in rows
+    ]
+    return characters, total
+
+
+def close_character_index():
+    global _connection
+    with _lock:
+        if _connection is not None:
+            _connection.close()
+            _connection = None
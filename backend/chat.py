@@ -1,19 +1,88 @@
-from fastapi import APIRouter
-from settings import load_settings
-from chat_infermaticai import chat_infermaticai
-from chat_openai import chat_openai
-from chat_googleaistudio import chat_googleaistudio
-from chat_common import ChatMessage
+from fastapi import APIRouter, HTTPException
+from settings import load_api_settings_for, load_settings
+from chat_infermaticai import prepare_infermaticai
+from chat_openai import prepare_openai
+from chat_googleaistudio import prepare_googleaistudio
+from chat_common import CharInfo, ChatEntry, ChatMessage, TokenLedger
+from stream_post import UpstreamRequest, stream_upstream
+from tokenizer import load_token_ledger
+from session_store import get_session_at
 
 router = APIRouter()
 
 
+# Appended to the session name of hedge requests, so they keep their own prompt caches
+HEDGE_SESSION_SUFFIX = "#hedge"
+
+
+async def prepare_chat(
+    api: str, message: ChatMessage, settings: dict, ledger: TokenLedger, hedge: bool = False
+) -> UpstreamRequest:
+    if api == "infermaticai":
+        return prepare_infermaticai(message, settings, ledger)
+    elif api == "openai":
+        return prepare_openai(message, settings, ledger)
+    elif api == "googleaistudio":
+        # A Gemini context cache takes a request to create, the hedge is sent without one
+        return await prepare_googleaistudio(message, settings, ledger, context_cache=not hedge)
+    raise ValueError(f"unknown api type: {api}")
+
+
+async def prepare_hedge(message: ChatMessage, ledger: TokenLedger) -> UpstreamRequest | None:
+    """Second request raced against the first one when "hedge" is enabled in the settings.
+
+    "api_type" picks the provider (default: the current one) and "overrides"
+    replaces keys of its api settings, e.g. another "api_key" or "model".
+    It is rendered under its own session id, so it does not replace the
+    primary's cached prompt prefix.
+    """
+    settings = load_settings()
+    hedge = settings.get("hedge", {})
+    if not hedge.get("enabled"):
+        return None
+    api = hedge.get("api_type", settings["api_type"])
+    api_settings = {**load_api_settings_for(api), **hedge.get("overrides", {})}
+    if message.session_name:
+        message = message.model_copy(update={"session_name": message.session_name + HEDGE_SESSION_SUFFIX})
+    request = await prepare_chat(api, message, api_settings, ledger, hedge=True)
+    request.label += " (hedge)"
+    return request
+
+
+async def load_session_message(message: ChatMessage) -> ChatMessage:
+    """Fill info and entries of a message that references a server-held session."""
+    if message.version is None:
+        raise HTTPException(status_code=400, detail="version is required with session")
+    session = (await get_session_at(message.session, message.version)).session
+    entries = [
+        ChatEntry.model_construct(id=entry.id, speaker=entry.speaker, content=entry.content, token_count=entry.token_count)
+        for entry in session.story_entries
+    ]
+    # Placeholder of the reply being generated
+    if entries and entries[-1].speaker != "Julien" and entries[-1].content == "":
+        entries.pop()
+    return message.model_copy(
+        update={
+            "system_token_count": session.system_token_count,
+            "info": CharInfo.model_validate(session.selected_char.info),
+            "entries": entries,
+            "session_name": session.session_name,
+        }
+    )
+
+
 @router.post("/api/chat")
 async def chat(message: ChatMessage):
+    if message.session is not None:
+        message = await load_session_message(message)
+    elif message.info is None:
+        raise HTTPException(status_code=400, detail="info and entries, or session, are required")
     settings = load_settings()
-    if settings["api_type"] == "infermaticai":
-        return await chat_infermaticai(message)
-    elif settings["api_type"] == "openai":
-        return await chat_openai(message)
-    elif settings["api_type"] == "googleaistudio":
-        return await chat_googleaistudio(message)
+    api = settings["api_type"]
+    # Entries are counted with the current api's tokenizer, the hedge reuses these counts
+    ledger = await load_token_ledger(message, "Julien")
+    request = await prepare_chat(api, message, load_api_settings_for(api), ledger)
+    hedge = await prepare_hedge(message, ledger)
+    if hedge is None:
+        return await stream_upstream(request)
+    return await stream_upstream(request, hedge, settings["hedge"].get("delay_ms", 1500))
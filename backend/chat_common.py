@@ -1,3 +1,7 @@
+import asyncio
+import bisect
+from collections import OrderedDict
+from dataclasses import dataclass, field
 from typing import List
 from pydantic import BaseModel
 
@@ -15,26 +19,166 @@ class CharInfo(BaseModel):
     mes_example: str
 
 class ChatMessage(BaseModel):
-    system_token_count: int
-    info: CharInfo
-    entries: List[ChatEntry]
-
-
-def find_start_index(system_token_count: int, entries: List[ChatEntry], max_token_count: int, user: str) -> int:
-    try:
-        total_tokens = system_token_count
-        for i in range(len(entries) - 1, -1, -1):
-            entry = entries[i]
-            if entry.token_count is not None:
-                if total_tokens + entry.token_count > max_token_count:
-                    # Find first non-user entry from i + 1
-                    for j in range(i + 1, len(entries)):
-                        if entries[j].speaker != user:
-                            return j
-                    return len(entries) - 1  # If no non-user entry found, return end of list
-                total_tokens += entry.token_count
-            
-        return 0
-    except Exception as e:
-        print(f"Error finding start index: {e}")
-        return 0
\ No newline at end of file
+    system_token_count: int = 0
+    info: CharInfo | None = None
+    entries: List[ChatEntry] = []
+    session_name: str | None = None
+    # Server-held session (see session_store) and its version, replacing info and entries
+    session: str | None = None
+    version: int | None = None
+
+    def session_id(self) -> str | None:
+        if not self.session_name:
+            return None
+        return f"{self.info.name}/{self.session_name}"
+
+
+# Number of sessions whose token ledger is kept in memory
+MAX_CACHED_LEDGERS = 32
+
+
+@dataclass
+class TokenLedger:
+    """Token counts of a session's entries with their prefix sums.
+
+    prefix[i] is the number of tokens in entries[:i], so the size of any
+    window entries[i:] is prefix[-1] - prefix[i].
+    """
+
+    # (id, content) of each counted entry, parallel to counts
+    keys: list = field(default_factory=list)
+    counts: list = field(default_factory=list)
+    prefix: list = field(default_factory=lambda: [0])
+    # Tokenizer the counts were made with, see tokenizer.get_counting_tokenizer_id
+    tokenizer_id: str | None = None
+    # Held while the ledger is brought up to date, counting entries awaits
+    lock: asyncio.Lock = field(default_factory=asyncio.Lock, repr=False, compare=False)
+
+    def copy(self) -> "TokenLedger":
+        """Counts as they are now, unaffected by later updates for other requests."""
+        return TokenLedger(list(self.keys), list(self.counts), list(self.prefix), self.tokenizer_id)
+
+    def first_changed(self, entries: List[ChatEntry]) -> int:
+        n = 0
+        limit = min(len(self.keys), len(entries))
+        while n < limit and self.keys[n] == (entries[n].id, entries[n].content):
+            n += 1
+        return n
+
+    def update(self, entries: List[ChatEntry], start: int):
+        """Replace everything from `start` on with `entries[start:]`, which must all be counted."""
+        del self.keys[start:]
+        del self.counts[start:]
+        del self.prefix[start + 1 :]
+        for entry in entries[start:]:
+            self.keys.append((entry.id, entry.content))
+            self.counts.append(entry.token_count)
+            self.prefix.append(self.prefix[-1] + entry.token_count)
+
+    def tokens_from(self, start_index: int) -> int:
+        return self.prefix[-1] - self.prefix[start_index]
+
+    def find_start_index(self, system_token_count: int, entries: List[ChatEntry], max_token_count: int, user: str) -> int:
+        # Smallest k with system + tokens_from(k) <= max_token_count
+        k = bisect.bisect_left(self.prefix, system_token_count + self.prefix[-1] - max_token_count)
+        if k == 0 or not entries:
+            return 0
+        # Find first non-user entry from k
+        for j in range(k, len(entries)):
+            if entries[j].speaker != user:
+                return j
+        return len(entries) - 1  # If no non-user entry found, return end of list
+
+
+_ledgers: OrderedDict[str, TokenLedger] = OrderedDict()
+
+
+def get_token_ledger(session_id: str | None) -> TokenLedger:
+    if session_id is None:
+        return TokenLedger()
+    ledger = _ledgers.get(session_id)
+    if ledger is None:
+        ledger = TokenLedger()
+        _ledgers[session_id] = ledger
+    _ledgers.move_to_end(session_id)
+    while len(_ledgers) > MAX_CACHED_LEDGERS:
+        _ledgers.popitem(last=False)
+    return ledger
+
+
+# Start index of each session's previous turn, with the id of the entry there
+_start_indices: OrderedDict[str, tuple[int, int]] = OrderedDict()
+
+
+def get_previous_start_index(session_id: str | None, entries: List[ChatEntry]) -> int | None:
+    """Start index of the session's previous turn, if it still points at the same entry."""
+    if session_id is None or session_id not in _start_indices:
+        return None
+    start_index, entry_id = _start_indices[session_id]
+    if start_index < len(entries) and entries[start_index].id == entry_id:
+        return start_index
+    return None
+
+
+def set_previous_start_index(session_id: str | None, entries: List[ChatEntry], start_index: int):
+    if session_id is None or start_index >= len(entries):
+        return
+    _start_indices[session_id] = (start_index, entries[start_index].id)
+    _start_indices.move_to_end(session_id)
+    while len(_start_indices) > MAX_CACHED_LEDGERS:
+        _start_indices.popitem(last=False)
+
+
+def find_sticky_start_index(
+    system_token_count: int,
+    entries: List[ChatEntry],
+    max_token_count: int,
+    user: str,
+    prev_start_index: int | None,
+    target_ratio: float,
+    ledger: TokenLedger,
+) -> tuple[int, bool]:
+    """Keep the previous start index while the context still fits.
+
+    When the budget is exceeded, history is dropped down to `target_ratio` of
+    the budget at once, so the first included message (and with it the
+    provider's prompt prefix cache) stays put for many turns.
+    Returns the start index and whether it is unchanged from the previous turn.
+    """
+    if (
+        prev_start_index is not None
+        and 0 <= prev_start_index < len(entries)
+        and system_token_count + ledger.tokens_from(prev_start_index) <= max_token_count
+    ):
+        return prev_start_index, True
+    start_index = ledger.find_start_index(system_token_count, entries, int(max_token_count * target_ratio), user)
+    return start_index, start_index == prev_start_index
+
+
+def select_start_index(
+    message: ChatMessage, max_token_count: int, user: str, settings: dict, ledger: TokenLedger
+) -> tuple[int, bool]:
+    """Pick the start index with the truncation mode of the api settings.
+
+    `ledger` must be up to date with message.entries.
+    "truncation": "sliding" (default) recomputes the window every turn,
+    "sticky" drops history in chunks down to "truncation_target" of the budget.
+    The previous turn's start index is kept per session here, not taken from the client.
+    """
+    session_id = message.session_id()
+    prev_start_index = get_previous_start_index(session_id, message.entries)
+    if settings.get("truncation", "sliding") == "sticky":
+        start_index, prefix_stable = find_sticky_start_index(
+            message.system_token_count,
+            message.entries,
+            max_token_count,
+            user,
+            prev_start_index,
+            settings.get("truncation_target", 0.7),
+            ledger,
+        )
+    else:
+        start_index = ledger.find_start_index(message.system_token_count, message.entries, max_token_count, user)
+        prefix_stable = start_index == prev_start_index
+    set_previous_start_index(session_id, message.entries, start_index)
+    return start_index, prefix_stable
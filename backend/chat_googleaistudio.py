@@ -1,23 +1,31 @@
 import json
-from chat_common import ChatMessage, find_start_index
-from settings import load_api_settings, load_preset
+from chat_common import ChatMessage, TokenLedger, select_start_index
+from prompt_plan import load_prompt_plan
 from prompt_googleai import make_googleaistudio_prompt
 from payload import make_googleaistudio_payload
-from stream_post import stream_post
+from stream_post import UpstreamRequest
+from tokenizer import make_stream_token_counter
+from http_client import GOOGLEAISTUDIO_URL
+from context_cache import apply_gemini_context_cache
 
+MODEL = "gemini-2.0-flash-thinking-exp-01-21"
 
-async def chat_googleaistudio(message: ChatMessage):
-    settings = load_api_settings()
-    preset = load_preset()
+
+async def prepare_googleaistudio(
+    message: ChatMessage, settings: dict, ledger: TokenLedger, context_cache: bool = True
+) -> UpstreamRequest:
+    plan = load_prompt_plan("googleaistudio")
+    preset = plan.preset
     wiBefore = ""
     wiAfter = ""
     persona = "Julien is living alone in a luxury mansion."
     user = "Julien"
-    start_index = find_start_index(
-        message.system_token_count,
-        message.entries,
+    start_index, prefix_stable = select_start_index(
+        message,
         preset["maxContext"] - settings["max_tokens"],
         user,
+        settings,
+        ledger,
     )
     print(f"start_index: {start_index}")
     payload = make_googleaistudio_prompt(
@@ -32,15 +40,20 @@ async def chat_googleaistudio(message: ChatMessage):
         persona,
         message.entries,
         start_index,
-        preset,
+        plan,
     )
     payload = make_googleaistudio_payload(payload, settings, preset)
-    print(json.dumps(payload, indent=2))
     api_key = settings["api_key"]
-    return await stream_post(
-        f"https://generativelanguage.googleapis.com/v1beta/models/gemini-2.0-flash-thinking-exp-01-21:streamGenerateContent?key={api_key}",
+    if context_cache:
+        payload = await apply_gemini_context_cache(message.session_id(), MODEL, api_key, payload, settings)
+    print(json.dumps(payload, indent=2))
+    return UpstreamRequest(
+        f"{GOOGLEAISTUDIO_URL}/v1beta/models/{MODEL}:streamGenerateContent?alt=sse&key={api_key}",
         None,
         payload,
         openai=False,
         start_index=start_index,
+        prefix_stable=prefix_stable,
+        token_counter=make_stream_token_counter("googleaistudio", settings),
+        label="googleaistudio",
     )
@@ -1,56 +1,33 @@
-import httpx
-import json
-from fastapi import HTTPException
-from fastapi.responses import StreamingResponse
-from settings import load_api_settings, load_preset
-from chat_common import ChatMessage, find_start_index
+from prompt_plan import load_prompt_plan
+from chat_common import ChatMessage, TokenLedger, select_start_index
+from stream_post import UpstreamRequest
 from prompt import make_prompt
 from payload import make_payload
+from tokenizer import make_stream_token_counter
+from http_client import INFERMATICAI_URL
 
 
-async def chat_infermaticai(message: ChatMessage):
-    settings = load_api_settings()
-    preset = load_preset()
-
-    async def generate():
-        async with httpx.AsyncClient() as client:
-            wiBefore = ""
-            wiAfter = ""
-            persona = "Julien is living alone in a luxury mansion."
-            user = "Julien"
-            start_index = find_start_index(
-                message.system_token_count, message.entries, preset["max_length"] - settings["max_tokens"], user)
-            print(f"start_index: {start_index}")
-            prompt = make_prompt(user, message.info.name, wiBefore, message.info.description,
-                                 message.info.personality, message.info.scenario, wiAfter, persona, message.entries, start_index)
-            payload = make_payload(prompt, settings, preset)
-
-            async with client.stream(
-                "POST",
-                "https://api.totalgpt.ai/v1/completions",
-                json=payload,
-                headers={
-                    "Authorization": f"Bearer {settings['api_key']}",
-                    "Content-Type": "application/json"
-                }
-            ) as response:
-                if response.status_code != 200:
-                    raise HTTPException(
-                        status_code=response.status_code, detail="API request failed")
-
-                async for line in response.aiter_lines():
-                    if line.startswith("data: "):
-                        data = line[6:]
-                        if data == "[DONE]":
-                            # Send the start_index when stream ends
-                            yield f"data: {json.dumps({'start_index': start_index})}\n\n"
-                            print(f"sent start_index: {start_index}")
-                            break
-                        try:
-                            json_data = json.loads(data)
-                            if text := json_data.get("choices", [{}])[0].get("text"):
-                                yield f"data: {json.dumps({'text': text})}\n\n"
-                        except json.JSONDecodeError:
-                            continue
-
-    return StreamingResponse(generate(), media_type="text/event-stream")
+def prepare_infermaticai(message: ChatMessage, settings: dict, ledger: TokenLedger) -> UpstreamRequest:
+    plan = load_prompt_plan("infermaticai")
+    preset = plan.preset
+    wiBefore = ""
+    wiAfter = ""
+    persona = "Julien is living alone in a luxury mansion."
+    user = "Julien"
+    start_index, prefix_stable = select_start_index(
+        message, preset["max_length"] - settings["max_tokens"], user, settings, ledger)
+    print(f"start_index: {start_index}")
+    prompt = make_prompt(user, message.info.name, wiBefore, message.info.description,
+                         message.info.personality, message.info.scenario, wiAfter, persona, message.entries, start_index,
+                         session_id=message.session_id())
+    payload = make_payload(prompt, settings, preset)
+    return UpstreamRequest(
+        f"{INFERMATICAI_URL}/v1/completions",
+        settings["api_key"],
+        payload,
+        openai=False,
+        start_index=start_index,
+        prefix_stable=prefix_stable,
+        token_counter=make_stream_token_counter("infermaticai", settings),
+        label=f"infermaticai:{settings['model']}",
+    )
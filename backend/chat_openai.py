@@ -1,22 +1,25 @@
 from prompt_openai import make_openai_prompt
-from settings import load_api_settings, load_preset
-from chat_common import ChatMessage, find_start_index
+from prompt_plan import load_prompt_plan
+from chat_common import ChatMessage, TokenLedger, select_start_index
 from payload import make_openai_payload
-from stream_post import stream_post
+from context_cache import add_cache_hints, load_cache_hint_settings
+from stream_post import UpstreamRequest
+from tokenizer import make_stream_token_counter
 
 
-async def chat_openai(message: ChatMessage):
-    settings = load_api_settings()
-    preset = load_preset()
+def prepare_openai(message: ChatMessage, settings: dict, ledger: TokenLedger) -> UpstreamRequest:
+    plan = load_prompt_plan("openai")
+    preset = plan.preset
     wiBefore = ""
     wiAfter = ""
     persona = "Julien is living alone in a luxury mansion."
     user = "Julien"
-    start_index = find_start_index(
-        message.system_token_count,
-        message.entries,
+    start_index, prefix_stable = select_start_index(
+        message,
         preset["openai_max_context"] - settings["max_tokens"],
         user,
+        settings,
+        ledger,
     )
     print(f"start_index: {start_index}")
     messages = make_openai_prompt(
@@ -31,7 +34,19 @@ async def chat_openai(message: ChatMessage):
         persona,
         message.entries,
         start_index,
-        preset,
+        plan,
+        cache_breakpoint=load_cache_hint_settings(settings)["cache_control"],
     )
     payload = make_openai_payload(messages, settings, preset)
-    return await stream_post(settings["custom_url"] + "/chat/completions", settings["api_key"], payload, start_index=start_index)
+    payload = add_cache_hints(payload, message.session_id(), settings)
+    return UpstreamRequest(
+        settings["custom_url"] + "/chat/completions",
+        settings["api_key"],
+        payload,
+        start_index=start_index,
+        prefix_stable=prefix_stable,
+        token_counter=make_stream_token_counter("openai", settings),
+        # Opt-in, servers like OpenAI's reject unknown fields
+        continue_final_message=settings.get("continue_final_message", False),
+        label=f"openai:{settings['model']}",
+    )
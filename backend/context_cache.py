@@ -0,0 +1,191 @@
+import asyncio
+import hashlib
+import time
+from collections import OrderedDict
+from dataclasses import dataclass
+import httpx
+from http_client import GOOGLEAISTUDIO_URL, get_client
+from sse_relay import dumps
+
+# Number of sessions whose provider-side cache is tracked
+MAX_CACHED_SESSIONS = 32
+
+DEFAULT_CONTEXT_CACHE_SETTINGS = {
+    "enabled": False,
+    # Lifetime of a Gemini cachedContents entry in seconds, extended while the session is used
+    "ttl": 3600,
+    # Latest contents always sent uncached, the rest of the history is cached with the system instruction
+    "uncached_contents": 2,
+    # Recreate the cache once this many contents follow it, so the cached part keeps up with the chat
+    "max_uncached_contents": 24,
+    # Gemini refuses caches below a minimum token count, smaller prefixes are not cached
+    "min_chars": 16384,
+}
+
+DEFAULT_CACHE_HINT_SETTINGS = {
+    # Send a per-session prompt_cache_key so requests of a session reach the same prefix cache
+    "prompt_cache_key": False,
+    # Mark the end of the static system block with cache_control
+    "cache_control": False,
+}
+
+
+@dataclass
+class CachedContext:
+    """A Gemini cachedContents entry holding the start of one session's prompt."""
+
+    # None when the provider refused to cache this prefix
+    name: str | None
+    api_key: str
+    prefix_hash: str
+    # Number of leading contents stored in the cache
+    prefix_len: int
+    expires: float
+
+
+_contexts: OrderedDict[str, CachedContext] = OrderedDict()
+# Deletions running in the background
+_tasks: set[asyncio.Task] = set()
+
+
+def load_context_cache_settings(settings: dict) -> dict:
+    return {**DEFAULT_CONTEXT_CACHE_SETTINGS, **settings.get("context_cache", {})}
+
+
+def load_cache_hint_settings(settings: dict) -> dict:
+    return {**DEFAULT_CACHE_HINT_SETTINGS, **settings.get("cache_hints", {})}
+
+
+def prefix_hash(model: str, api_key: str, payload: dict, prefix_len: int) -> str:
+    key = [model, api_key, payload.get("systemInstruction"), payload["contents"][:prefix_len]]
+    return hashlib.sha1(dumps(key)).hexdigest()
+
+
+def prefix_chars(payload: dict, prefix_len: int) -> int:
+    contents = [payload.get("systemInstruction") or {}, *payload["contents"][:prefix_len]]
+    return sum(len(part.get("text", "")) for content in contents for part in content.get("parts", []))
+
+
+def use_cached_context(payload: dict, context: CachedContext) -> dict:
+    """Payload sending only what follows the cached prefix."""
+    payload = {key: value for key, value in payload.items() if key != "systemInstruction"}
+    payload["contents"] = payload["contents"][context.prefix_len :]
+    payload["cachedContent"] = context.name
+    return payload
+
+
+async def create_cached_content(model: str, api_key: str, payload: dict, prefix_len: int, ttl: int) -> str:
+    body = {
+        "model": f"models/{model}",
+        "contents": payload["contents"][:prefix_len],
+        "ttl": f"{ttl}s",
+    }
+    if payload.get("systemInstruction"):
+        body["systemInstruction"] = payload["systemInstruction"]
+    response = await get_client(GOOGLEAISTUDIO_URL).post(
+        f"{GOOGLEAISTUDIO_URL}/v1beta/cachedContents", params={"key": api_key}, json=body
+    )
+    if response.status_code != 200:
+        raise RuntimeError(f"cachedContents returned {response.status_code}: {response.text[:200]}")
+    return response.json()["name"]
+
+
+async def update_cached_content_ttl(name: str, api_key: str, ttl: int):
+    response = await get_client(GOOGLEAISTUDIO_URL).patch(
+        f"{GOOGLEAISTUDIO_URL}/v1beta/{name}",
+        params={"key": api_key, "updateMask": "ttl"},
+        json={"ttl": f"{ttl}s"},
+    )
+    if response.status_code != 200:
+        raise RuntimeError(f"cachedContents returned {response.status_code}: {response.text[:200]}")
+
+
+async def delete_cached_content(name: str, api_key: str):
+    try:
+        await get_client(GOOGLEAISTUDIO_URL).delete(f"{GOOGLEAISTUDIO_URL}/v1beta/{name}", params={"key": api_key})
+    except httpx.HTTPError as e:
+        print(f"Failed to delete {name}: {e}")
+
+
+def drop_context(context: CachedContext | None):
+    """Delete the provider-side cache of a context that is no longer used, without waiting."""
+    if context is None or context.name is None:
+        return
+    task = asyncio.create_task(delete_cached_content(context.name, context.api_key))
+    _tasks.add(task)
+    task.add_done_callback(_tasks.discard)
+
+
+def store_context(session_id: str, context: CachedContext):
+    _contexts[session_id] = context
+    _contexts.move_to_end(session_id)
+    while len(_contexts) > MAX_CACHED_SESSIONS:
+        drop_context(_contexts.popitem(last=False)[1])
+
+
+async def apply_gemini_context_cache(
+    session_id: str | None, model: str, api_key: str, payload: dict, settings: dict
+) -> dict:
+    """Move the system instruction and early history of a Gemini payload into a cachedContents entry.
+
+    The entry is kept per session (character and session name) and reused
+    while the start of the prompt is unchanged. Its TTL is extended when less
+    than half of it is left. It is replaced when the prefix changes (an
+    edited entry, or truncation moving the start index) or when too many
+    contents follow it. When caching is off or fails, the payload is
+    returned unchanged.
+    """
+    cache_settings = load_context_cache_settings(settings)
+    if not cache_settings["enabled"] or session_id is None:
+        return payload
+    ttl = cache_settings["ttl"]
+    contents = payload["contents"]
+    now = time.time()
+
+    context = _contexts.get(session_id)
+    if (
+        context is not None
+        and context.prefix_len < len(contents)
+        and len(contents) - context.prefix_len <= cache_settings["max_uncached_contents"]
+        and context.expires > now
+        and context.prefix_hash == prefix_hash(model, api_key, payload, context.prefix_len)
+    ):
+        _contexts.move_to_end(session_id)
+        if context.name is None:
+            return payload
+        if context.expires - now < ttl / 2:
+            try:
+                await update_cached_content_ttl(context.name, api_key, ttl)
+                context.expires = now + ttl
+            except (httpx.HTTPError, RuntimeError) as e:
+                print(f"Failed to extend {context.name}: {e}")
+        return use_cached_context(payload, context)
+
+    drop_context(_contexts.pop(session_id, None))
+    prefix_len = len(contents) - cache_settings["uncached_contents"]
+    if prefix_len <= 0 or prefix_chars(payload, prefix_len) < cache_settings["min_chars"]:
+        return payload
+    context = CachedContext(None, api_key, prefix_hash(model, api_key, payload, prefix_len), prefix_len, now + ttl)
+    try:
+        context.name = await create_cached_content(model, api_key, payload, prefix_len, ttl)
+        print(f"Cached {prefix_len} contents of {session_id} as {context.name}")
+    except (httpx.HTTPError, RuntimeError, KeyError) as e:
+        # Remembered, so the same prefix is not offered again every turn
+        print(f"Context cache not created for {session_id}: {e}")
+    store_context(session_id, context)
+    return use_cached_context(payload, context) if context.name is not None else payload
+
+
+def add_cache_hints(payload: dict, session_id: str | None, settings: dict) -> dict:
+    """Add a per-session prompt_cache_key to an OpenAI-compatible payload if enabled."""
+    if session_id is not None and load_cache_hint_settings(settings)["prompt_cache_key"]:
+        payload["prompt_cache_key"] = hashlib.sha1(session_id.encode("utf-8")).hexdigest()
+    return payload
+
+
+async def close_context_caches():
+    """Delete every tracked cache instead of paying for storage until its TTL ends."""
+    while _contexts:
+        drop_context(_contexts.popitem()[1])
+    if _tasks:
+        await asyncio.gather(*_tasks, return_exceptions=True)
@@ -1,9 +1,10 @@
-from fastapi import APIRouter, HTTPException
+from fastapi import APIRouter, HTTPException, Request
 from pydantic import BaseModel
 from typing import List
 import os
 import win32api
 from send2trash import send2trash
+from upload import resolve_data_path, save_upload
 
 router = APIRouter()
 
@@ -146,6 +147,20 @@ async def save_binary(data: SaveBinary):
         raise HTTPException(status_code=500, detail=str(e))
 
 
+@router.post("/api/upload")
+async def upload_file(request: Request, path: str):
+    """Save the request body, raw or the "file" part of a multipart form, to a path under /data.
+
+    Replaces /api/save-image and /api/save-binary without base64 or JSON.
+    """
+    full_path = resolve_data_path(path)
+    try:
+        result = await save_upload(request, full_path)
+    except OSError as e:
+        raise HTTPException(status_code=500, detail=str(e))
+    return {"status": "success", "path": path, "url": f"{path}?v={result['sha256'][:16]}", **result}
+
+
 class DeleteFile(BaseModel):
     path: str
 
@@ -1,8 +1,9 @@
 from fastapi import APIRouter, HTTPException
 from pydantic import BaseModel
 from typing import Optional
+import asyncio
+import hashlib
 import random
-import base64
 from io import BytesIO
 from PIL import Image
 from impact.face_detailer import FaceDetailer, tensor2pil
@@ -30,11 +31,21 @@ vae_decoder = None
 detailer = None
 
 
-def image_to_base64(image: Image.Image) -> str:
+def save_generated_image(image: Image.Image) -> str:
+    """Save an image under data/generated named after its content, return its versioned path."""
     buffered = BytesIO()
     image.save(buffered, format="PNG")
-    img_str = base64.b64encode(buffered.getvalue()).decode()
-    return f"data:image/png;base64,{img_str}"
+    data = buffered.getvalue()
+    version = hashlib.sha256(data).hexdigest()[:16]
+    path = f"generated/{version}.png"
+    full_path = get_data_path(path)
+    if not os.path.exists(full_path):
+        os.makedirs(os.path.dirname(full_path), exist_ok=True)
+        tmp_path = f"{full_path}.tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(data)
+        os.replace(tmp_path, full_path)
+    return f"{path}?v={version}"
 
 
 def encode(clip, text):
@@ -133,11 +144,11 @@ async def generate_image(request: ImageGenerationRequest):
             None,
         )
 
-        # Convert the image to base64
+        # Served by the /data mount instead of being sent as base64
         enhanced_img = tensor2pil(enhanced_image[0])
-        image_base64 = image_to_base64(enhanced_img)
+        path = await asyncio.to_thread(save_generated_image, enhanced_img)
 
-        return {"success": True, "image": image_base64, "prompt": request.prompt}
+        return {"success": True, "path": path, "prompt": request.prompt}
     except Exception as e:
         import traceback
         print(f"Error occurred: {str(e)}")
@@ -0,0 +1,154 @@
+import asyncio
+import httpx
+from fastapi import HTTPException
+from settings import load_settings
+
+try:
+    import h2  # noqa: F401
+
+    HTTP2_AVAILABLE = True
+except ImportError:
+    HTTP2_AVAILABLE = False
+
+INFERMATICAI_URL = "https://api.totalgpt.ai"
+GOOGLEAISTUDIO_URL = "https://generativelanguage.googleapis.com"
+
+DEFAULT_HTTP_SETTINGS = {
+    "timeout": 60.0,
+    "connect_timeout": 10.0,
+    "max_connections": 20,
+    "max_keepalive_connections": 10,
+    "keepalive_expiry": 60.0,
+    "http2": True,
+    # Streamed requests running at once per provider and API key, and how many may queue behind them
+    "max_concurrent_requests": 4,
+    "max_queued_requests": 8,
+    "queue_timeout": 30.0,
+}
+
+# One client per provider base URL, shared by every request
+_clients: dict[str, httpx.AsyncClient] = {}
+# One limiter per (provider base URL, API key)
+_limiters: dict[tuple[str, str | None], "RequestLimiter"] = {}
+
+
+def base_url_of(url: str) -> str:
+    parsed = httpx.URL(url)
+    port = f":{parsed.port}" if parsed.port else ""
+    return f"{parsed.scheme}://{parsed.host}{port}"
+
+
+def provider_for(base_url: str) -> str | None:
+    settings = load_settings()
+    if base_url == INFERMATICAI_URL:
+        return "infermaticai"
+    if base_url == GOOGLEAISTUDIO_URL:
+        return "googleaistudio"
+    custom_url = settings.get("openai", {}).get("custom_url")
+    if custom_url and base_url_of(custom_url) == base_url:
+        return "openai"
+    return None
+
+
+def load_http_settings(provider: str | None) -> dict:
+    """Merge the per-provider "http" block of settings.json over the defaults."""
+    settings = load_settings()
+    http_settings = dict(DEFAULT_HTTP_SETTINGS)
+    http_settings.update(settings.get("http", {}))
+    if provider is not None:
+        http_settings.update(settings.get(provider, {}).get("http", {}))
+    return http_settings
+
+
+def create_client(base_url: str) -> httpx.AsyncClient:
+    http_settings = load_http_settings(provider_for(base_url))
+    return httpx.AsyncClient(
+        http2=http_settings["http2"] and HTTP2_AVAILABLE,
+        timeout=httpx.Timeout(http_settings["timeout"], connect=http_settings["connect_timeout"]),
+        limits=httpx.Limits(
+            max_connections=http_settings["max_connections"],
+            max_keepalive_connections=http_settings["max_keepalive_connections"],
+            keepalive_expiry=http_settings["keepalive_expiry"],
+        ),
+    )
+
+
+def get_client(url: str) -> httpx.AsyncClient:
+    """Return the pooled client for the base URL of `url`, creating it on first use."""
+    base_url = base_url_of(url)
+    client = _clients.get(base_url)
+    if client is None or client.is_closed:
+        client = create_client(base_url)
+        _clients[base_url] = client
+    return client
+
+
+async def open_clients():
+    settings = load_settings()
+    get_client(INFERMATICAI_URL)
+    get_client(GOOGLEAISTUDIO_URL)
+    custom_url = settings.get("openai", {}).get("custom_url")
+    if custom_url:
+        get_client(custom_url)
+
+
+async def close_clients():
+    for client in list(_clients.values()):
+        await client.aclose()
+    _clients.clear()
+
+
+
+class RequestLimiter:
+    """Caps the requests in flight to one provider and key, with a bounded wait queue."""
+
+    def __init__(self, max_concurrent: int, max_queued: int, queue_timeout: float):
+        self.semaphore = asyncio.Semaphore(max_concurrent)
+        self.max_queued = max_queued
+        self.queue_timeout = queue_timeout
+        self.queued = 0
+        self.active = 0
+
+    async def acquire(self):
+        """Wait for a free slot and return the function that releases it.
+
+        Raises a 429 when the queue is full or the wait times out, instead of
+        letting the burst reach the provider.
+        """
+        if self.semaphore.locked() and self.queued >= self.max_queued:
+            raise HTTPException(status_code=429, detail="Too many requests queued for this provider")
+        self.queued += 1
+        try:
+            await asyncio.wait_for(self.semaphore.acquire(), self.queue_timeout)
+        except asyncio.TimeoutError:
+            raise HTTPException(status_code=429, detail="Timed out waiting for a free request slot")
+        finally:
+            self.queued -= 1
+        self.active += 1
+        released = False
+
+        def release():
+            nonlocal released
+            if not released:
+                released = True
+                self.active -= 1
+                self.semaphore.release()
+
+        return release
+
+
+def get_limiter(url: str, api_key: str | None) -> RequestLimiter:
+    base_url = base_url_of(url)
+    if api_key is None:
+        # Google AI Studio passes the key in the query string
+        api_key = httpx.URL(url).params.get("key")
+    limiter = _limiters.get((base_url, api_key))
+    if limiter is None:
+        http_settings = load_http_settings(provider_for(base_url))
+        limiter = RequestLimiter(
+            http_settings["max_concurrent_requests"],
+            http_settings["max_queued_requests"],
+            http_settings["queue_timeout"],
+        )
+        _limiters[(base_url, api_key)] = limiter
+    return limiter
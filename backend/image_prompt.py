@@ -4,6 +4,7 @@ import json
 from settings import load_api_settings, load_preset, load_settings
 from payload import make_payload, make_openai_payload, make_googleaistudio_payload
 from stream_post import stream_post
+from http_client import INFERMATICAI_URL, GOOGLEAISTUDIO_URL
 
 router = APIRouter()
 
@@ -57,7 +58,7 @@ async def scene_to_prompt_infermaticai(scene: SceneContent):
         payload = make_payload(system_prompt, settings, preset, stream=True)
         print("payload:", json.dumps(payload, indent=2))
 
-        return await stream_post("https://api.totalgpt.ai/v1/completions", settings["api_key"], payload, openai=False)
+        return await stream_post(f"{INFERMATICAI_URL}/v1/completions", settings["api_key"], payload, openai=False)
 
     except Exception as e:
         print(e)
@@ -169,7 +170,7 @@ async def scene_to_prompt_googleaistudio(scene: SceneContent):
         print("payload:", json.dumps(payload, indent=2))
         api_key = settings["api_key"]
         return await stream_post(
-            f"https://generativelanguage.googleapis.com/v1beta/models/gemini-2.0-flash-thinking-exp-01-21:streamGenerateContent?key={api_key}",
+            f"{GOOGLEAISTUDIO_URL}/v1beta/models/gemini-2.0-flash-thinking-exp-01-21:streamGenerateContent?alt=sse&key={api_key}",
             None,
             payload,
             openai=False,
@@ -1,6 +1,6 @@
-import httpx
 from fastapi import APIRouter, Query, HTTPException
 from settings import load_settings
+from http_client import get_client, INFERMATICAI_URL
 
 router = APIRouter()
 
@@ -8,22 +8,22 @@ router = APIRouter()
 async def get_model_infermaticai():
     try:
         settings = load_settings()
-        with httpx.Client() as client:
-            response = client.get(
-                "https://api.totalgpt.ai/v1/models",
-                headers={
-                    "Authorization": f'Bearer {settings["infermaticai"]["api_key"]}'
-                },
-            )
-            if response.status_code == 200:
-                result = response.json()
-                print(result)
-                models = sorted([x["id"]
-                                for x in result["data"]], key=str.lower)
-                return {"success": True, "models": models}
-            else:
-                print(response)
-                return {"success": False, "message": response.text}
+        client = get_client(INFERMATICAI_URL)
+        response = await client.get(
+            f"{INFERMATICAI_URL}/v1/models",
+            headers={
+                "Authorization": f'Bearer {settings["infermaticai"]["api_key"]}'
+            },
+        )
+        if response.status_code == 200:
+            result = response.json()
+            print(result)
+            models = sorted([x["id"]
+                            for x in result["data"]], key=str.lower)
+            return {"success": True, "models": models}
+        else:
+            print(response)
+            return {"success": False, "message": response.text}
     except Exception as e:
         print(e)
         return {"success": False, "message": str(e)}
@@ -32,22 +32,23 @@ async def get_model_infermaticai():
 async def get_model_openai():
     try:
         settings = load_settings()
-        with httpx.Client() as client:
-            response = client.get(
-                settings["openai"]["custom_url"] + "/models",
-                headers={
-                    "Authorization": f'Bearer {settings["openai"]["api_key"]}'
-                },
-            )
-            if response.status_code == 200:
-                result = response.json()
-                print(result)
-                models = sorted([x["id"]
-                                for x in result["data"]], key=str.lower)
-                return {"success": True, "models": models}
-            else:
-                print(response)
-                return {"success": False, "message": response.text}
+        url = settings["openai"]["custom_url"] + "/models"
+        client = get_client(url)
+        response = await client.get(
+            url,
+            headers={
+                "Authorization": f'Bearer {settings["openai"]["api_key"]}'
+            },
+        )
+        if response.status_code == 200:
+            result = response.json()
+            print(result)
+            models = sorted([x["id"]
+                            for x in result["data"]], key=str.lower)
+            return {"success": True, "models": models}
+        else:
+            print(response)
+            return {"success": False, "message": response.text}
     except Exception as e:
         print(e)
         return {"success": False, "message": str(e)}
@@ -104,3 +104,52 @@ def make_googleaistudio_payload(payload: dict, settings: dict, preset: dict, str
     ]
 
     return payload
+
+
+def make_continuation_payload(
+    payload: dict, partial: str, used_tokens: int | None = None, continue_final_message: bool = False
+) -> dict:
+    """Copy of payload that asks the model to continue after the partial reply.
+
+    used_tokens, the tokens of the partial reply, are taken off the output
+    limit so the whole reply stays within it. continue_final_message sends
+    vLLM's flags that make OpenAI-compatible servers extend the assistant
+    prefill instead of starting a new turn.
+    """
+    payload = dict(payload)
+    if "contents" in payload:
+        # Google AI Studio: the reply so far becomes (or extends) the last model turn
+        contents = list(payload["contents"])
+        if contents and contents[-1].get("role") == "model":
+            last = contents.pop()
+            parts = [*last.get("parts", []), {"text": partial}]
+            contents.append({**last, "parts": parts})
+        else:
+            contents.append({"role": "model", "parts": [{"text": partial}]})
+        payload["contents"] = contents
+        generation_config = payload.get("generationConfig")
+        if used_tokens is not None and generation_config and "maxOutputTokens" in generation_config:
+            payload["generationConfig"] = {
+                **generation_config,
+                "maxOutputTokens": max(1, generation_config["maxOutputTokens"] - used_tokens),
+            }
+        return payload
+    if "messages" in payload:
+        # OpenAI: the reply so far is sent as an assistant prefill
+        messages = list(payload["messages"])
+        if messages and messages[-1].get("role") == "assistant":
+            last = messages.pop()
+            messages.append({**last, "content": last.get("content", "") + partial})
+        else:
+            messages.append({"role": "assistant", "content": partial})
+        payload["messages"] = messages
+        if continue_final_message:
+            payload["continue_final_message"] = True
+            payload["add_generation_prompt"] = False
+    else:
+        # Text completion: the reply so far continues the prompt
+        payload["prompt"] = payload["prompt"] + partial
+    for key in ("max_tokens", "max_completion_tokens"):
+        if used_tokens is not None and payload.get(key) is not None:
+            payload[key] = max(1, payload[key] - used_tokens)
+    return payload
@@ -1,18 +1,65 @@
-import settings
-from pybars import Compiler
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from prompt_plan import PromptPlan, load_prompt_plan, compile_template
 import html
 
+# Number of sessions whose rendered prompt prefix is kept in memory
+MAX_CACHED_SESSIONS = 32
 
-def make_prompt(user: str, char: str, wiBefore: str, description: str, personality: str, scenario: str, wiAfter: str, persona: str, entries: list, start_index: int) -> str:
-    context = settings.load_context()
-    instruct = settings.load_instruct()
 
-    # Initialize Handlebars compiler
-    compiler = Compiler()
+def render_system(plan: PromptPlan, template_data: dict) -> str:
+    # Render the story
+    story_string = plan.story_template(template_data)
+
+    template = compile_template(story_string)
+    story_string = template(template_data)
+
+    return html.unescape(story_string)
+
+
+def serialize_entry(instruct: dict, user: str, entry, first: bool) -> str:
+    if first:
+        return entry.content + instruct["output_suffix"]
+    if entry.speaker == user:
+        return instruct["input_sequence"] + entry.content + instruct["input_suffix"]
+    return instruct["output_sequence"] + entry.content + instruct["output_suffix"]
+
+
+@dataclass
+class RenderedPrefix:
+    """System block and serialized chat entries of one session's last prompt."""
+
+    plan: PromptPlan
+    system_key: tuple
+    start_index: int
+    system: str
+    # (id, speaker, content) of each serialized entry, parallel to pieces
+    keys: list = field(default_factory=list)
+    pieces: list = field(default_factory=list)
 
-    # Compile the story template
-    template = compiler.compile(
-        context["story_string"] + context["chat_start"] + '\n' + instruct["first_output_sequence"])
+    def update(self, entries: list, user: str):
+        """Drop pieces from the first changed entry on and serialize the rest."""
+        n = 0
+        limit = min(len(self.keys), len(entries))
+        while n < limit and self.keys[n] == (entries[n].id, entries[n].speaker, entries[n].content):
+            n += 1
+        del self.keys[n:]
+        del self.pieces[n:]
+        for i in range(n, len(entries)):
+            entry = entries[i]
+            self.keys.append((entry.id, entry.speaker, entry.content))
+            self.pieces.append(serialize_entry(self.plan.instruct, user, entry, i == 0))
+
+    def render(self) -> str:
+        return "".join([self.system, *self.pieces, self.plan.instruct["last_output_sequence"]])
+
+
+_prefix_cache: OrderedDict[str, RenderedPrefix] = OrderedDict()
+
+
+def make_prompt(user: str, char: str, wiBefore: str, description: str, personality: str, scenario: str, wiAfter: str, persona: str, entries: list, start_index: int, session_id: str | None = None) -> str:
+    plan = load_prompt_plan("infermaticai")
+    instruct = plan.instruct
 
     # Prepare context data with rendered system_prompt
     template_data = {
@@ -26,30 +73,28 @@ def make_prompt(user: str, char: str, wiBefore: str, description: str, personali
         "user": user,
         "char": char
     }
+    system_key = tuple(template_data.values())
 
-    # Render the story
-    story_string = template(template_data)
+    prefix = _prefix_cache.get(session_id) if session_id is not None else None
+    if (
+        prefix is None
+        or prefix.plan is not plan
+        or prefix.system_key != system_key
+        or prefix.start_index != start_index
+    ):
+        prefix = RenderedPrefix(plan, system_key, start_index, render_system(plan, template_data))
 
-    template = compiler.compile(story_string)
-    story_string = template(template_data)
+    prefix.update(entries[start_index:], user)
 
-    story_string = html.unescape(story_string)
+    if session_id is not None:
+        _prefix_cache[session_id] = prefix
+        _prefix_cache.move_to_end(session_id)
+        while len(_prefix_cache) > MAX_CACHED_SESSIONS:
+            _prefix_cache.popitem(last=False)
 
-    story_string += entries[start_index].content + instruct["output_suffix"]
-    for entry in entries[start_index + 1:]:
-        if entry.speaker == user:
-            story_string += instruct["input_sequence"] + \
-                entry.content + instruct["input_suffix"]
-        else:
-            story_string += instruct["output_sequence"] + \
-                entry.content + instruct["output_suffix"]
-    story_string += instruct["last_output_sequence"]
-    return story_string
+    return prefix.render()
 
 
 def make_prompt_single(user: str, entry: list) -> str:
-    instruct = settings.load_instruct()
-    if entry.speaker == user:
-        return instruct["input_sequence"] + entry.content + instruct["input_suffix"]
-    else:
-        return instruct["output_sequence"] + entry.content + instruct["output_suffix"]
+    instruct = load_prompt_plan("infermaticai").instruct
+    return serialize_entry(instruct, user, entry, False)
@@ -1,5 +1,5 @@
 from chat_common import ChatEntry
-from prompt_openai import find_prompt
+from prompt_plan import PromptPlan
 from prompt_googleai_risu import compile_prompt
 
 
@@ -51,17 +51,15 @@ def make_googleaistudio_prompt(
     persona,
     entries: list[ChatEntry],
     start_index,
-    preset,
+    plan: PromptPlan,
 ) -> dict:
     system_prompt = []
     contents = []
-    if "prompts" in preset:
-        role, content = find_prompt(preset["prompts"], "main", user, name)
-        system_prompt.append(content)
+    if plan.main_prompt is not None:
+        system_prompt.append(plan.main_prompt_for(user, name))
         system_prompt.append(persona)
         system_prompt.append(personality)
         system_prompt.append(description)
-        role, content = find_prompt(preset["prompts"], "nsfw", user, name)
         system_prompt.append("[Start a new Chat]")
         text = "\n\n".join(system_prompt)
 
@@ -72,33 +70,28 @@ def make_googleaistudio_prompt(
             ],
             "systemInstruction": {"parts": [{"text": text}]},
         }
-    elif "promptTemplate" in preset:
+    elif plan.risu_items is not None:
         values = {
             "user": user,
             "char": name,
             "slot": "",
         }
         first = True
-        for prompt in preset["promptTemplate"]:
-            if prompt["type"] == "plain":
-                text = compile_prompt(prompt["text"], values)
-                role = "model" if prompt["role"] == "bot" else "user"
-                contents.append({"role": role, "parts": [{"text": text}]})
-            elif prompt["type"] == "persona":
+        for item in plan.risu_items:
+            if item.type == "plain":
+                text = compile_prompt(item.text, values)
+                contents.append({"role": item.role, "parts": [{"text": text}]})
+            elif item.type == "persona":
                 values["slot"] = persona
-                text = compile_prompt(prompt["innerFormat"], values)
+                text = compile_prompt(item.text, values)
                 contents.append({"role": "user", "parts": [{"text": text}]})
-            elif prompt["type"] == "description":
+            elif item.type == "description":
                 values["slot"] = description
-                text = compile_prompt(prompt["innerFormat"], values)
+                text = compile_prompt(item.text, values)
                 contents.append({"role": "user", "parts": [{"text": text}]})
-            elif prompt["type"] == "lorebook":
-                pass
-            elif prompt["type"] == "memory":
-                pass
-            elif prompt["type"] == "chat":
-                start = calc_index(prompt["rangeStart"], start_index, len(entries))
-                end = calc_index(prompt["rangeEnd"], start_index, len(entries))
+            elif item.type == "chat":
+                start = calc_index(item.range_start, start_index, len(entries))
+                end = calc_index(item.range_end, start_index, len(entries))
                 if first:
                     contents.append({"role": "user", "parts": [{"text": "[Start a new Chat]"}]})
                     first = False
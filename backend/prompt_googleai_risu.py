@@ -1,4 +1,7 @@
+import functools
+import operator
 import random
+from typing import Callable
 
 global_vars = {
     "jailbreak": 1,
@@ -22,210 +25,222 @@ def skip_whitespace(text: str, pos: int) -> int:
 
 
 def parse_number(text: str, pos: int) -> tuple[int, int]:
-    num = ""
+    start = pos
     while pos < len(text) and text[pos].isdigit():
-        num += text[pos]
         pos += 1
-    return int(num) if num else 0, pos
+    return int(text[start:pos]) if pos > start else 0, pos
 
 
-def parse_random(text: str, pos: int) -> tuple[str, int]:
-    if text[pos:].startswith("{{random::"):
-        end = text.find("}}", pos)
-        if end == -1:
-            raise Exception("Invalid random: expect }} got " + text[pos:])
-        value_str = text[pos + 10 : end]
-        value_list = value_str.split("::")
-        value = random.choice(value_list)
-        return value, end + 2
-    return "", pos
+def exception_context(error: str, text: str, pos: int):
+    return error + text[pos] + "\nContext:\n" + text[pos - 20 : pos + 20] + "\n" + " " * 20 + "^"
 
 
-def parse_roll(text: str, pos: int) -> tuple[str, int]:
-    if text[pos:].startswith("{{roll::"):
-        end = text.find("}}", pos)
-        if end == -1:
-            raise Exception("Invalid roll: expect }} got " + text[pos:])
-        value_str = text[pos + 8 : end]
-        max_value = int(value_str)
-        result = str(random.randint(1, max_value))
-        return result, end + 2
-    return "", pos
+# Templates are compiled once into a tree of closures. A template compiles to a
+# render function `(values) -> str`, an expression compiles to `() -> int`.
+# Everything that depends on `values`, `global_vars` or the random generator is
+# evaluated at render time, so a compiled template can be reused across requests.
 
 
-def parse_var_expr(text: str, pos: int) -> tuple[int, int]:
-    if text[pos:].startswith("{{getglobalvar::"):
+def compile_random(text: str, pos: int) -> tuple[Callable[[], str], int]:
+    end = text.find("}}", pos)
+    if end == -1:
+        raise Exception("Invalid random: expect }} got " + text[pos:])
+    value_list = text[pos + 10 : end].split("::")
+    return lambda: random.choice(value_list), end + 2
+
+
+def compile_roll(text: str, pos: int) -> tuple[Callable[[], str], int]:
+    end = text.find("}}", pos)
+    if end == -1:
+        raise Exception("Invalid roll: expect }} got " + text[pos:])
+    max_value = int(text[pos + 8 : end])
+    if max_value < 1:
+        raise Exception("Invalid roll: expect positive number got " + text[pos + 8 : end])
+    return lambda: str(random.randint(1, max_value)), end + 2
+
+
+def compile_var_expr(text: str, pos: int) -> tuple[Callable[[], int], int]:
+    if text.startswith("{{getglobalvar::", pos):
         end = text.find("}}", pos)
         if end == -1:
             raise Exception("Invalid getglobalvar: expect }} got " + text[pos:])
         var_id = text[pos + 16 : end]
-        value = get_global_var(var_id)
-        return value, end + 2
-    elif text[pos:].startswith("{{lastmessageid}}"):
-        return 0, pos + 17
-    elif text[pos:].startswith("{{random::"):
-        value_str, pos = parse_random(text, pos)
-        return int(value_str), pos
-    elif text[pos:].startswith("{{roll::"):
-        value_str, pos = parse_roll(text, pos)
-        return int(value_str), pos
-    return parse_number(text, pos)
-
-
-def parse_keyword(text: str, pos: int, values: dict) -> tuple[str, int]:
-    if text[pos:].startswith("{{user}}"):
-        return values["user"], pos + 8
-    if text[pos:].startswith("{{char}}"):
-        return values["char"], pos + 8
-    if text[pos:].startswith("{{slot}}"):
-        parsed_value, _ = parse_template(values["slot"], 0, values)
-        return parsed_value, pos + 8
-    if text[pos:].startswith("{{/}}"):
+        return lambda: get_global_var(var_id), end + 2
+    elif text.startswith("{{lastmessageid}}", pos):
+        return lambda: 0, pos + 17
+    elif text.startswith("{{random::", pos):
+        choose, pos = compile_random(text, pos)
+        return lambda: int(choose()), pos
+    elif text.startswith("{{roll::", pos):
+        roll, pos = compile_roll(text, pos)
+        return lambda: int(roll()), pos
+    value, pos = parse_number(text, pos)
+    return lambda: value, pos
+
+
+def compile_keyword(text: str, pos: int) -> tuple[Callable[[dict], str] | str, int]:
+    if text.startswith("{{user}}", pos):
+        return lambda values: values["user"], pos + 8
+    if text.startswith("{{char}}", pos):
+        return lambda values: values["char"], pos + 8
+    if text.startswith("{{slot}}", pos):
+        return lambda values: compile_template_text(values["slot"])(values), pos + 8
+    if text.startswith("{{/}}", pos):
         pos += 5
         if pos < len(text) and text[pos] == "\n":
             return "", pos + 1
         return "", pos
-    if text[pos:].startswith("{{random::"):
-        value_str, pos = parse_random(text, pos)
-        return value_str, pos
+    if text.startswith("{{random::", pos):
+        choose, pos = compile_random(text, pos)
+        return lambda values: choose(), pos
     raise Exception("Unknown keyword: " + text[pos:])
 
 
-def exception_context(error: str, text: str, pos: int):
-    return error + text[pos] + "\nContext:\n" + text[pos - 20 : pos + 20] + "\n" + " " * 20 + "^"
+def binary_op(op: Callable[[int, int], int], left: Callable[[], int], right: Callable[[], int]) -> Callable[[], int]:
+    return lambda: op(left(), right())
 
 
-def parse_term(text: str, pos: int) -> tuple[int, int]:
+def compile_term(text: str, pos: int) -> tuple[Callable[[], int], int]:
     if pos < len(text) and text[pos] == "(":
         pos = skip_whitespace(text, pos + 1)
-        value, pos = parse_expression(text, pos)
+        expr, pos = compile_expression(text, pos)
         pos = skip_whitespace(text, pos)
         if pos < len(text) and text[pos] == ")":
-            return value, pos + 1
+            return expr, pos + 1
         else:
             raise Exception(exception_context("Invalid term: expect ) got ", text, pos))
-    return parse_var_expr(text, pos)
+    return compile_var_expr(text, pos)
 
 
-def parse_mult_expr(text: str, pos: int) -> tuple[int, int]:
-    value, pos = parse_term(text, pos)
+def compile_mult_expr(text: str, pos: int) -> tuple[Callable[[], int], int]:
+    expr, pos = compile_term(text, pos)
     pos = skip_whitespace(text, pos)
 
     while pos < len(text) and text[pos] in "*":
-        op = text[pos]
         pos = skip_whitespace(text, pos + 1)
-        right_value, pos = parse_term(text, pos)
-
-        if op == "*":
-            value *= right_value
-
+        right, pos = compile_term(text, pos)
+        expr = binary_op(operator.mul, expr, right)
         pos = skip_whitespace(text, pos)
 
-    return value, pos
+    return expr, pos
 
 
-def parse_add_expr(text: str, pos: int) -> tuple[int, int]:
-    value, pos = parse_mult_expr(text, pos)
+def compile_add_expr(text: str, pos: int) -> tuple[Callable[[], int], int]:
+    expr, pos = compile_mult_expr(text, pos)
     pos = skip_whitespace(text, pos)
 
     while pos < len(text) and text[pos] in "+":
-        op = text[pos]
         pos = skip_whitespace(text, pos + 1)
-        right_value, pos = parse_mult_expr(text, pos)
+        right, pos = compile_mult_expr(text, pos)
+        expr = binary_op(operator.add, expr, right)
+        pos = skip_whitespace(text, pos)
 
-        if op == "+":
-            value += right_value
+    return expr, pos
 
-        pos = skip_whitespace(text, pos)
 
-    return value, pos
+COMPARISONS = {
+    "<": lambda a, b: int(a < b),
+    ">": lambda a, b: int(a > b),
+    "=": lambda a, b: int(a == b),
+}
 
 
-def parse_expression(text: str, pos: int) -> tuple[int, int]:
-    value, pos = parse_add_expr(text, pos)
+def compile_expression(text: str, pos: int) -> tuple[Callable[[], int], int]:
+    expr, pos = compile_add_expr(text, pos)
     pos = skip_whitespace(text, pos)
 
     while pos < len(text) and text[pos] in "=<>":
-        op = text[pos]
+        op = COMPARISONS[text[pos]]
         pos = skip_whitespace(text, pos + 1)
-        right_value, pos = parse_term(text, pos)
-
-        if op == "<":
-            value = int(value < right_value)
-        elif op == ">":
-            value = int(value > right_value)
-        elif op == "=":
-            value = int(value == right_value)
-
+        right, pos = compile_term(text, pos)
+        expr = binary_op(op, expr, right)
         pos = skip_whitespace(text, pos)
 
-    return value, pos
+    return expr, pos
 
 
-def parse_condition(text: str, pos: int) -> tuple[bool, int]:
-    if text[pos:].startswith("{{?"):
+def compile_condition(text: str, pos: int) -> tuple[Callable[[], int], int]:
+    if text.startswith("{{?", pos):
         pos += 3  # Skip {{?
         pos = skip_whitespace(text, pos)
 
-        value, pos = parse_expression(text, pos)
+        expr, pos = compile_expression(text, pos)
 
-        if text[pos:].startswith("}}"):
-            return bool(value), pos + 2
+        if text.startswith("}}", pos):
+            return expr, pos + 2
         else:
             raise Exception("Invalid condition: expect }} got " + text[pos:])
     else:
-        return parse_var_expr(text, pos)
+        return compile_var_expr(text, pos)
 
 
-def parse_if_expr(text: str, pos: int, values: dict) -> tuple[str, int]:
-    if not text[pos:].startswith("{{#if"):
+def compile_if_expr(text: str, pos: int) -> tuple[Callable[[dict], str], int]:
+    if not text.startswith("{{#if", pos):
         raise Exception("Invalid if expression: expect {{#if got " + text[pos])
 
     pos += 5  # Skip {{#if
     pos = skip_whitespace(text, pos)
-    condition_value, pos = parse_condition(text, pos)
+    condition, pos = compile_condition(text, pos)
     pos = skip_whitespace(text, pos)
-    if text[pos:].startswith("}}"):
+    if text.startswith("}}", pos):
         pos += 2  # Skip }}
     else:
         raise Exception("Invalid if expression: expect }} got " + text[pos:])
 
-    result = []
-    if condition_value:
-        template_text, pos = parse_template(text, pos, values)
-        result.append(template_text)
-    else:
-        _, pos = parse_template(text, pos, values)
+    body, pos = compile_template(text, pos)
 
-    if text[pos:].startswith("{{/if}}"):
+    if text.startswith("{{/if}}", pos):
         pos += 7  # Skip {{/if}}
-        return "".join(result), pos
+        return lambda values: body(values) if condition() else "", pos
 
     raise Exception(
         "Invalid if expression: expect {{/if}} got: " + (text[pos:] if pos < len(text) else text[pos - 20 :])
     )
 
 
-def parse_template(text: str, pos: int, values: dict) -> tuple[str, int]:
-    result = []
+def compile_template(text: str, pos: int) -> tuple[Callable[[dict], str], int]:
+    # Literal text is kept as str, everything else as a render function
+    parts = []
     while pos < len(text):
-        if text[pos:].startswith("{{#if"):
-            template_text, pos = parse_if_expr(text, pos, values)
-            result.append(template_text)
-        elif text[pos:].startswith("{{/if}}"):
+        if text.startswith("{{#if", pos):
+            node, pos = compile_if_expr(text, pos)
+            parts.append(node)
+        elif text.startswith("{{/if}}", pos):
             break
-        # elif text[pos:].startswith("{{getglobalvar::"):
-        #     value, new_pos = parse_var_expr(text, pos)
-        #     result.append(str(value))
-        #     pos = new_pos
-        elif text[pos:].startswith("{{"):
-            template_text, pos = parse_keyword(text, pos, values)
-            result.append(template_text)
+        elif text.startswith("{{", pos):
+            node, pos = compile_keyword(text, pos)
+            parts.append(node)
         else:
-            result.append(text[pos])
-            pos += 1
+            end = text.find("{{", pos)
+            if end == -1:
+                end = len(text)
+            parts.append(text[pos:end])
+            pos = end
+
+    parts = [part for part in parts if part != ""]
+    if all(isinstance(part, str) for part in parts):
+        literal = "".join(parts)
+        return lambda values: literal, pos
+    return lambda values: "".join(part if isinstance(part, str) else part(values) for part in parts), pos
+
+
+@functools.lru_cache(maxsize=1024)
+def compile_template_text(text: str) -> Callable[[dict], str]:
+    """Compile a template once and cache the render function by its text.
+
+    A template that fails to compile is cached as a render function that
+    re-raises the error, so broken presets are not re-parsed on every request.
+    """
+    try:
+        render, _ = compile_template(text, 0)
+        return render
+    except Exception as e:
+        error = e
+
+        def render_error(values: dict) -> str:
+            raise error
 
-    return "".join(result), pos
+        return render_error
 
 
 # template   ->
@@ -253,8 +268,7 @@ def parse_template(text: str, pos: int, values: dict) -> tuple[str, int]:
 
 def compile_prompt(text: str, values: dict) -> str:
     try:
-        result, _ = parse_template(text, 0, values)
-        return result
+        return compile_template_text(text)(values)
     except Exception as e:
         print("Error parsing prompt:", e)
         return ""
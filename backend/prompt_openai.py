@@ -1,25 +1,19 @@
-from pybars import Compiler
+from prompt_plan import PromptPlan, render_template
 
 
 def compile_prompt(text: str, user: str, char: str, slot: str = "") -> str:
-    compiler = Compiler()
-    template = compiler.compile(text)
-    template_data = {"user": user, "char": char, "slot": slot}
-    result = template(template_data)
-    return result
-
-
-def find_prompt(prompts: list, id: str, user, char) -> str:
-    for prompt in prompts:
-        if prompt["identifier"] == id:
-            return prompt["role"], compile_prompt(prompt["content"], user, char)
-    return "system", ""
+    return render_template(text, user, char, slot)
 
 
 def append(messages: list, role: str, content: str, user, char):
     messages.append({"role": role, "content": compile_prompt(content, user, char)})
 
 
+def mark_cache_breakpoint(message: dict):
+    """Ask the server to cache the prompt up to and including this message."""
+    message["content"] = [{"type": "text", "text": message["content"], "cache_control": {"type": "ephemeral"}}]
+
+
 def make_openai_prompt(
     user,
     char,
@@ -32,36 +26,34 @@ def make_openai_prompt(
     persona,
     entries: list,
     start_index: int,
-    preset: dict,
+    plan: PromptPlan,
+    cache_breakpoint: bool = False,
 ) -> list:
+    slots = {
+        "wiBefore": wiBefore,
+        "persona": persona,
+        "description": description,
+        "personality": personality,
+        "scenario": scenario,
+        "wiAfter": wiAfter,
+        "mes_example": mes_example,
+    }
     messages = []
-    prompts = preset["prompts"]
-    prompt_order = preset["prompt_order"][1]["order"]
 
-    for order in prompt_order:
-        if order["enabled"]:
-            if order["identifier"] == "main" or order["identifier"] == "nsfw" or order["identifier"] == "jailbreak":
-                role, content = find_prompt(prompts, order["identifier"], user, char)
-                append(messages, role, content, user, char)
-            elif order["identifier"] == "worldInfoBefore" and wiBefore != "":
-                append(messages, "system", wiBefore, user, char)
-            elif order["identifier"] == "personaDescription":
-                append(messages, "system", persona, user, char)
-            elif order["identifier"] == "charDescription":
-                append(messages, "system", description, user, char)
-            elif order["identifier"] == "charPersonality":
-                append(messages, "system", personality, user, char)
-            elif order["identifier"] == "scenario":
-                append(messages, "system", scenario, user, char)
-            elif order["identifier"] == "worldInfoAfter" and wiAfter != "":
-                append(messages, "system", wiAfter, user, char)
-            elif order["identifier"] == "dialogueExamples":
-                append(messages, "system", mes_example, user, char)
-            elif order["identifier"] == "chatHistory":
-                append(messages, "system", "[Start a new Chat]", user, char)
-                for entry in entries[start_index:]:
-                    role = "user" if entry.speaker == user else "assistant"
-                    message = {"role": role, "content": entry.content}
-                    messages.append(message)
+    for segment in plan.skeleton(user, char):
+        if segment.slot is None:
+            messages.append({"role": segment.role, "content": segment.text})
+        elif segment.slot == "history":
+            # Everything before the history is the same every turn
+            if cache_breakpoint and messages:
+                mark_cache_breakpoint(messages[-1])
+            for entry in entries[start_index:]:
+                role = "user" if entry.speaker == user else "assistant"
+                message = {"role": role, "content": entry.content}
+                messages.append(message)
+        elif segment.slot in ("wiBefore", "wiAfter") and slots[segment.slot] == "":
+            continue
+        else:
+            append(messages, segment.role, slots[segment.slot], user, char)
 
     return messages
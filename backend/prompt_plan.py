@@ -0,0 +1,199 @@
+import functools
+from dataclasses import dataclass, field
+from typing import Callable, NamedTuple
+from pybars import Compiler
+from settings import EMPTY_SNAPSHOT, load_json_snapshot, load_settings, preset_paths_for
+from prompt_googleai_risu import compile_template_text
+
+# Prompt order identifiers whose content comes from the preset itself
+STATIC_IDENTIFIERS = ("main", "nsfw", "jailbreak")
+
+# Prompt order identifiers filled per turn, mapped to the slot name they use
+SLOT_IDENTIFIERS = {
+    "worldInfoBefore": "wiBefore",
+    "personaDescription": "persona",
+    "charDescription": "description",
+    "charPersonality": "personality",
+    "scenario": "scenario",
+    "worldInfoAfter": "wiAfter",
+    "dialogueExamples": "mes_example",
+}
+
+_compiler = Compiler()
+
+
+@functools.lru_cache(maxsize=1024)
+def compile_template(text: str) -> Callable:
+    """Compile a Handlebars template once and cache it by its text."""
+    return _compiler.compile(text)
+
+
+def render_template(text: str, user: str, char: str, slot: str = "") -> str:
+    return compile_template(text)({"user": user, "char": char, "slot": slot})
+
+
+class Segment(NamedTuple):
+    role: str
+    # Raw preset text of a static segment, None for a slot
+    text: str | None = None
+    # Name of the dynamic part filled per turn ("history" for the chat entries)
+    slot: str | None = None
+
+
+class RisuItem(NamedTuple):
+    type: str
+    role: str = "user"
+    text: str = ""
+    range_start: int | str = 0
+    range_end: int | str = "end"
+
+
+@dataclass(frozen=True)
+class PromptPlan:
+    """Everything about a preset that does not change from turn to turn.
+
+    Static segments are rendered once per (user, char) and memoized, so a turn
+    only has to fill in the slots and splice the chat history.
+    """
+
+    preset: dict
+    instruct: dict
+    context: dict
+    # Chat completion order (openai) as static segments and slots
+    segments: tuple[Segment, ...] = ()
+    # Main prompt text used for the Gemini system instruction
+    main_prompt: str | None = None
+    # Risu prompt template items (googleaistudio)
+    risu_items: tuple[RisuItem, ...] | None = None
+    # Instruct mode story string template (infermaticai)
+    story_template: Callable | None = None
+    _rendered: dict = field(default_factory=dict, compare=False, repr=False)
+
+    def skeleton(self, user: str, char: str) -> tuple[Segment, ...]:
+        """Segments with static text rendered for `user` and `char`."""
+        key = ("skeleton", user, char)
+        if key not in self._rendered:
+            self._rendered[key] = tuple(
+                segment
+                if segment.slot is not None
+                else segment._replace(
+                    text=render_template(render_template(segment.text, user, char), user, char)
+                )
+                for segment in self.segments
+            )
+        return self._rendered[key]
+
+    def main_prompt_for(self, user: str, char: str) -> str:
+        key = ("main_prompt", user, char)
+        if key not in self._rendered:
+            self._rendered[key] = render_template(self.main_prompt or "", user, char)
+        return self._rendered[key]
+
+
+def find_prompt(prompts: list, id: str) -> tuple[str, str]:
+    for prompt in prompts:
+        if prompt["identifier"] == id:
+            return prompt["role"], prompt["content"]
+    return "system", ""
+
+
+# SillyTavern keeps the order the user edits under this character id, next to its defaults
+PROMPT_ORDER_CHARACTER_ID = 100001
+
+
+def find_prompt_order(preset: dict) -> list:
+    """Order entries of a preset, those of PROMPT_ORDER_CHARACTER_ID or else the last ones."""
+    prompt_order = preset["prompt_order"]
+    if not prompt_order:
+        return []
+    for entry in prompt_order:
+        if entry.get("character_id") == PROMPT_ORDER_CHARACTER_ID:
+            return entry["order"]
+    return prompt_order[-1]["order"]
+
+
+def compile_segments(preset: dict) -> tuple[Segment, ...]:
+    prompts = {prompt["identifier"]: prompt for prompt in reversed(preset.get("prompts", []))}
+    segments = []
+    for order in find_prompt_order(preset):
+        if not order["enabled"]:
+            continue
+        identifier = order["identifier"]
+        if identifier in STATIC_IDENTIFIERS:
+            prompt = prompts.get(identifier, {"role": "system", "content": ""})
+            segments.append(Segment(prompt["role"], text=prompt["content"]))
+        elif identifier in SLOT_IDENTIFIERS:
+            segments.append(Segment("system", slot=SLOT_IDENTIFIERS[identifier]))
+        elif identifier == "chatHistory":
+            segments.append(Segment("system", text="[Start a new Chat]"))
+            segments.append(Segment("system", slot="history"))
+    return tuple(segments)
+
+
+def compile_risu_items(preset: dict) -> tuple[RisuItem, ...]:
+    items = []
+    for prompt in preset["promptTemplate"]:
+        if prompt["type"] == "plain":
+            items.append(RisuItem("plain", "model" if prompt["role"] == "bot" else "user", prompt["text"]))
+        elif prompt["type"] in ("persona", "description"):
+            items.append(RisuItem(prompt["type"], text=prompt["innerFormat"]))
+        elif prompt["type"] == "chat":
+            items.append(RisuItem("chat", range_start=prompt["rangeStart"], range_end=prompt["rangeEnd"]))
+    # Warm the template cache so the first turn does not pay for parsing
+    for item in items:
+        compile_template_text(item.text)
+    return tuple(items)
+
+
+def compile_plan(preset: dict, instruct: dict, context: dict) -> PromptPlan:
+    segments = ()
+    main_prompt = None
+    risu_items = None
+    story_template = None
+    if "prompt_order" in preset:
+        segments = compile_segments(preset)
+    if "prompts" in preset:
+        main_prompt = find_prompt(preset["prompts"], "main")[1]
+    if "promptTemplate" in preset:
+        risu_items = compile_risu_items(preset)
+    if instruct and context:
+        story_template = compile_template(
+            context["story_string"] + context["chat_start"] + "\n" + instruct["first_output_sequence"]
+        )
+    return PromptPlan(
+        preset=preset,
+        instruct=instruct,
+        context=context,
+        segments=segments,
+        main_prompt=main_prompt,
+        risu_items=risu_items,
+        story_template=story_template,
+    )
+
+
+# Latest plan per set of preset files, with the snapshots it was built from
+_plans: dict[tuple, tuple[tuple, PromptPlan]] = {}
+
+
+def load_json(path: str | None) -> dict:
+    if path is None:
+        return EMPTY_SNAPSHOT
+    return load_json_snapshot(path)
+
+
+def load_prompt_plan(api: str | None = None) -> PromptPlan:
+    """Return the compiled plan for the preset of `api` (default: current api_type).
+
+    The plan is rebuilt only when one of its files has been modified.
+    """
+    if api is None:
+        api = load_settings()["api_type"]
+    paths = preset_paths_for(api)
+    key = (paths["preset"], paths["instruct"], paths["context"])
+    snapshots = tuple(load_json(path) for path in key)
+    cached = _plans.get(key)
+    if cached is not None and all(a is b for a, b in zip(cached[0], snapshots)):
+        return cached[1]
+    plan = compile_plan(*snapshots)
+    _plans[key] = (snapshots, plan)
+    return plan
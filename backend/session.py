@@ -1,8 +1,13 @@
-from fastapi import APIRouter
-from pydantic import BaseModel
+import asyncio
+from typing import Annotated, Literal, Union
+from fastapi import APIRouter, HTTPException, Request
+from pydantic import BaseModel, Field
 from settings import get_data_path
+from upload import resolve_data_path, save_upload
+from static_files import versioned_path
 import os
 import json
+import tempfile
 from datetime import datetime
 
 router = APIRouter()
@@ -14,7 +19,7 @@ class Character(BaseModel):
 
 class ImageEntry(BaseModel):
     image: str | None = None
-    path: str
+    path: str | None = None
     width: int
     height: int
     prompt: str
@@ -45,62 +50,214 @@ class LoadSessionImage(BaseModel):
     session_name: str
     index: int
 
-@router.post("/api/save-session")
-async def save_session(session: Session):
-    try:
-        if session.selected_char.file_name.endswith('.card'):
-            file_name = session.selected_char.file_name[:-4]
-        
-        # Create directory for character and session
-        session_dir = get_data_path(f'sessions/{file_name}/{session.session_name}')
-        if not os.path.exists(session_dir):
-            os.makedirs(session_dir)
+def session_dir_for(char_name: str, session_name: str) -> str:
+    """Directory of a session, char_name being the card file name without ".card"."""
+    return get_data_path(f'sessions/{char_name}/{session_name}')
 
-        # Save session data
-        path = os.path.join(session_dir, 'session.json')
-        with open(path, 'w') as f:
-            json.dump(session.model_dump(), f, indent=2)
-        return {"success": True}
-    except Exception as e:
-        print(f"Error creating sessions directory: {e}")
-        return {"success": False}
+def char_name_of(session: Session) -> str:
+    file_name = session.selected_char.file_name
+    return file_name[:-5] if file_name.endswith('.card') else file_name
+
+# Entries are written as a snapshot (session.json) followed by a journal of the
+# ops applied since, the journal is folded into a new snapshot once it grows
+SESSION_FILE = 'session.json'
+JOURNAL_FILE = 'journal.jsonl'
+# Journal records written before the session is compacted into a new snapshot
+MAX_JOURNAL_RECORDS = 64
+
+class AppendEntry(BaseModel):
+    op: Literal["append"]
+    entry: StoryEntry
+
+class EditEntry(BaseModel):
+    op: Literal["edit"]
+    id: int
+    speaker: str | None = None
+    content: str | None = None
+    state: str | None = None
+    token_count: int | None = None
+
+class DeleteEntries(BaseModel):
+    op: Literal["delete"]
+    ids: list[int]
+
+class AddImage(BaseModel):
+    op: Literal["add_image"]
+    id: int
+    image: ImageEntry
+
+class SetActiveImage(BaseModel):
+    op: Literal["set_active_image"]
+    id: int
+    active_image: int | None
+
+SessionOp = Annotated[
+    Union[AppendEntry, EditEntry, DeleteEntries, AddImage, SetActiveImage], Field(discriminator="op")
+]
+
+class JournalRecord(BaseModel):
+    # Per-session counter, one more than the previous change; records not newer
+    # than the seq of the snapshot are already part of it
+    seq: int
+    ops: list[SessionOp]
+    system_token_count: int | None = None
+
+def apply_ops(entries: list[StoryEntry], ops: list) -> list[StoryEntry]:
+    """Return a new entry list with the ops applied, leaving `entries` untouched.
+
+    Edited entries are copied, so a failing op leaves the stored session as it was.
+    """
+    entries = list(entries)
+    positions = {entry.id: i for i, entry in enumerate(entries)}
 
-class LoadLastSession(BaseModel):
-    name: str
+    def position(id: int) -> int:
+        if id not in positions:
+            raise HTTPException(status_code=404, detail=f"Entry not found: {id}")
+        return positions[id]
 
-@router.post("/api/load-last-session")
-async def load_last_session(data: LoadLastSession):
+    for op in ops:
+        if op.op == "append":
+            if op.entry.id in positions:
+                raise HTTPException(status_code=400, detail=f"Duplicate entry id: {op.entry.id}")
+            positions[op.entry.id] = len(entries)
+            entries.append(op.entry)
+        elif op.op == "edit":
+            i = position(op.id)
+            entries[i] = entries[i].model_copy(update=op.model_dump(exclude={"op", "id"}, exclude_none=True))
+        elif op.op == "delete":
+            removed = {position(id) for id in op.ids}
+            entries = [entry for i, entry in enumerate(entries) if i not in removed]
+            positions = {entry.id: i for i, entry in enumerate(entries)}
+        elif op.op == "add_image":
+            i = position(op.id)
+            images = [*entries[i].images, op.image]
+            entries[i] = entries[i].model_copy(update={"images": images, "active_image": len(images) - 1})
+        elif op.op == "set_active_image":
+            i = position(op.id)
+            if op.active_image is not None and not 0 <= op.active_image < len(entries[i].images):
+                raise HTTPException(status_code=400, detail=f"No image {op.active_image} in entry {op.id}")
+            entries[i] = entries[i].model_copy(update={"active_image": op.active_image})
+    return entries
+
+def apply_record(session: Session, record: JournalRecord) -> Session:
+    update = {"story_entries": apply_ops(session.story_entries, record.ops)}
+    if record.system_token_count is not None:
+        update["system_token_count"] = record.system_token_count
+    return session.model_copy(update=update)
+
+def write_session(session: Session, seq: int):
+    """Write a snapshot of the whole session and drop the journal it replaces.
+
+    The snapshot goes to a temporary file renamed over session.json, so a
+    crash leaves either the old or the new snapshot. seq is the session's
+    counter when `session` was read: records of a journal left behind by a
+    crash before the journal is removed are not newer and are skipped on
+    load, records created while the snapshot is written are newer.
+    """
+    session_dir = session_dir_for(char_name_of(session), session.session_name)
+    os.makedirs(session_dir, exist_ok=True)
+    data = {**session.model_dump(), "seq": seq}
+    fd, tmp_path = tempfile.mkstemp(dir=session_dir, prefix='.session-', suffix='.tmp')
     try:
-        # Get the sessions directory for the character
-        char_dir = get_data_path(f'sessions/{data.name}')
-        if not os.path.exists(char_dir):
-            return {"success": False, "message": "No sessions found for this character"}
-
-        # List all session directories and sort by modification time
-        session_dirs = []
-        for session_name in os.listdir(char_dir):
-            session_path = os.path.join(char_dir, session_name)
-            if os.path.isdir(session_path):
-                json_path = os.path.join(session_path, 'session.json')
-                if os.path.exists(json_path):
-                    session_dirs.append((session_path, os.path.getmtime(json_path)))
-        
-        if not session_dirs:
-            return {"success": False, "message": "No sessions found for this character"}
+        with os.fdopen(fd, 'w') as f:
+            json.dump(data, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, os.path.join(session_dir, SESSION_FILE))
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+    journal_path = os.path.join(session_dir, JOURNAL_FILE)
+    if os.path.exists(journal_path):
+        os.remove(journal_path)
 
-        # Get the most recent session directory
-        latest_session_dir = max(session_dirs, key=lambda x: x[1])[0]
-        session_name = os.path.basename(latest_session_dir)
-        
-        # Load and return the session data
-        json_path = os.path.join(latest_session_dir, 'session.json')
-        with open(json_path, 'r') as f:
-            session_data = json.load(f)
-            return {"success": True, "session": session_data, "session_name": session_name}
+def append_session_journal(session: Session, records: list[JournalRecord]):
+    """Append records to the journal of a session that already has a snapshot, in one write."""
+    session_dir = session_dir_for(char_name_of(session), session.session_name)
+    with open(os.path.join(session_dir, JOURNAL_FILE), 'a') as f:
+        f.write(''.join(record.model_dump_json() + '\n' for record in records))
+        f.flush()
 
-    except Exception as e:
-        print(f"Error loading last session: {e}")
-        return {"success": False, "message": str(e)}
+def read_session_journal(path: str, seq: int) -> tuple[list[JournalRecord], int]:
+    """Records of a journal newer than seq, and the highest seq found in it (at least seq).
+
+    A last line cut short by a crash is truncated, so the next record starts on
+    its own line. Other unreadable records are skipped and left in the file.
+    """
+    records = []
+    if not os.path.exists(path):
+        return records, seq
+    torn_offset = None
+    with open(path, 'rb') as f:
+        offset = 0
+        for line in f:
+            try:
+                record = JournalRecord.model_validate_json(line)
+            except ValueError as e:
+                if not line.endswith(b'\n'):
+                    torn_offset = offset
+                    break
+                print(f"Skipping unreadable journal record at byte {offset} of {path}: {e}")
+                offset += len(line)
+                continue
+            offset += len(line)
+            if record.seq > seq:
+                records.append(record)
+                seq = record.seq
+    if torn_offset is not None:
+        print(f"Truncating torn journal record at byte {torn_offset} of {path}")
+        with open(path, 'r+b') as f:
+            f.truncate(torn_offset)
+    return records, seq
+
+def read_session_records(char_name: str, session_name: str) -> tuple[Session, int, int] | None:
+    """Snapshot with the journal replayed on it, the number of records replayed and the session's seq.
+
+    A session.json written before the journal existed has no seq and loads
+    as a snapshot with an empty journal.
+    """
+    session_dir = session_dir_for(char_name, session_name)
+    path = os.path.join(session_dir, SESSION_FILE)
+    if not os.path.exists(path):
+        return None
+    with open(path, 'r') as f:
+        data = json.load(f)
+    seq = data.pop('seq', 0)
+    session = Session.model_validate(data)
+    records, seq = read_session_journal(os.path.join(session_dir, JOURNAL_FILE), seq)
+    for record in records:
+        session = apply_record(session, record)
+    return session, len(records), seq
+
+def read_session_seq(char_name: str, session_name: str) -> int:
+    """Latest seq of a session on disk without replaying its journal, 0 when there is none."""
+    session_dir = session_dir_for(char_name, session_name)
+    try:
+        with open(os.path.join(session_dir, SESSION_FILE), 'r') as f:
+            seq = json.load(f).get('seq', 0)
+    except (OSError, ValueError):
+        return 0
+    try:
+        with open(os.path.join(session_dir, JOURNAL_FILE), 'rb') as f:
+            for line in f:
+                try:
+                    seq = max(seq, json.loads(line)['seq'])
+                except (ValueError, KeyError, TypeError):
+                    continue
+    except FileNotFoundError:
+        pass
+    return seq
+
+def session_mtime(session_dir: str) -> float | None:
+    """Time of the latest write to a session, None if it has no snapshot."""
+    mtimes = []
+    for file_name in (SESSION_FILE, JOURNAL_FILE):
+        try:
+            mtimes.append(os.path.getmtime(os.path.join(session_dir, file_name)))
+        except FileNotFoundError:
+            if file_name == SESSION_FILE:
+                return None
+    return max(mtimes)
 
 @router.post("/api/save-session-image")
 async def save_session_image(data: SaveSessionImage):
@@ -128,6 +285,17 @@ async def save_session_image(data: SaveSessionImage):
         print(f"Error saving session image: {e}")
         return {"success": False, "message": str(e)}
 
+@router.post("/api/upload/session-image")
+async def upload_session_image(request: Request, character_name: str, session_name: str, index: str):
+    """save-session-image with the PNG as the request body, raw or multipart, instead of base64."""
+    try:
+        relative_path = f'sessions/{character_name}/{session_name}/{index}.png'
+        result = await save_upload(request, resolve_data_path(relative_path))
+        return {"success": True, "path": relative_path, "url": f"{relative_path}?v={result['sha256'][:16]}", **result}
+    except OSError as e:
+        print(f"Error saving session image: {e}")
+        return {"success": False, "message": str(e)}
+
 @router.post("/api/load-session-image")
 async def load_session_image(data: LoadSessionImage):
     try:
@@ -138,12 +306,9 @@ async def load_session_image(data: LoadSessionImage):
         if not os.path.exists(image_path):
             return {"success": False, "message": "Image not found"}
             
-        # Read and encode image
-        import base64
-        with open(image_path, 'rb') as f:
-            image_data = f.read()
-            base64_image = base64.b64encode(image_data).decode('utf-8')
-            return {"success": True, "image": f"data:image/png;base64,{base64_image}"}
+        # Served by the /data mount, the version lets browsers cache it
+        relative_path = f'sessions/{data.character_name}/{data.session_name}/{data.index}.png'
+        return {"success": True, "path": await asyncio.to_thread(versioned_path, relative_path, image_path)}
 
     except Exception as e:
         print(f"Error loading session image: {e}")
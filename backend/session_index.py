@@ -0,0 +1,141 @@
+import os
+import sqlite3
+import threading
+import time
+from settings import get_data_path
+from session import JOURNAL_FILE, SESSION_FILE, Session, char_name_of, read_session_records, session_dir_for, session_mtime
+
+# One row per session, updated when it is written, so listing a character's sessions is one query
+_connection = None
+_lock = threading.Lock()
+
+
+def get_connection() -> sqlite3.Connection:
+    global _connection
+    if _connection is None:
+        _connection = sqlite3.connect(get_data_path("session_index.db"), check_same_thread=False)
+        _connection.executescript(
+            "CREATE TABLE IF NOT EXISTS sessions ("
+            "character TEXT NOT NULL, session_name TEXT NOT NULL, updated_at REAL NOT NULL, "
+            "entry_count INTEGER NOT NULL, size INTEGER NOT NULL, "
+            "PRIMARY KEY (character, session_name));"
+            "CREATE INDEX IF NOT EXISTS sessions_by_update ON sessions (character, updated_at DESC);"
+            # mtime of each character's session directory when it was last compared with the index
+            "CREATE TABLE IF NOT EXISTS character_dirs (character TEXT PRIMARY KEY, mtime_ns INTEGER NOT NULL);"
+        )
+        _connection.commit()
+    return _connection
+
+
+def session_size(session_dir: str) -> int:
+    size = 0
+    for file_name in (SESSION_FILE, JOURNAL_FILE):
+        try:
+            size += os.path.getsize(os.path.join(session_dir, file_name))
+        except FileNotFoundError:
+            pass
+    return size
+
+
+def index_session(session: Session, updated_at: float | None = None):
+    """Record a session that was just written, called from the writing thread."""
+    char_name = char_name_of(session)
+    row = (
+        char_name,
+        session.session_name,
+        updated_at if updated_at is not None else time.time(),
+        len(session.story_entries),
+        session_size(session_dir_for(char_name, session.session_name)),
+    )
+    with _lock:
+        connection = get_connection()
+        connection.execute("INSERT OR REPLACE INTO sessions VALUES (?, ?, ?, ?, ?)", row)
+        connection.commit()
+
+
+def remove_session(char_name: str, session_name: str):
+    with _lock:
+        connection = get_connection()
+        connection.execute("DELETE FROM sessions WHERE character = ? AND session_name = ?", (char_name, session_name))
+        connection.commit()
+
+
+def index_character(char_name: str):
+    """Bring the sessions of a character in line with its directory when the directory changed.
+
+    Sessions added outside of the app (written before the index existed,
+    copied in) are added, and those deleted are removed. The directory's
+    mtime is taken before listing it, so a session written meanwhile makes
+    the next call look again.
+    """
+    char_dir = get_data_path(f"sessions/{char_name}")
+    try:
+        mtime_ns = os.stat(char_dir).st_mtime_ns
+    except FileNotFoundError:
+        mtime_ns = 0
+    with _lock:
+        connection = get_connection()
+        row = connection.execute("SELECT mtime_ns FROM character_dirs WHERE character = ?", (char_name,)).fetchone()
+        if row is not None and row[0] == mtime_ns:
+            return
+        indexed = {
+            session_name
+            for (session_name,) in connection.execute("SELECT session_name FROM sessions WHERE character = ?", (char_name,))
+        }
+    on_disk = set(os.listdir(char_dir)) if mtime_ns else set()
+    removed = [session_name for session_name in indexed if session_name not in on_disk]
+    added = []
+    for session_name in sorted(on_disk - indexed):
+        session_dir = os.path.join(char_dir, session_name)
+        mtime = session_mtime(session_dir) if os.path.isdir(session_dir) else None
+        if mtime is None:
+            continue
+        try:
+            loaded = read_session_records(char_name, session_name)
+        except (OSError, ValueError) as e:
+            print(f"Not indexing session {char_name}/{session_name}: {e}")
+            continue
+        added.append((char_name, session_name, mtime, len(loaded[0].story_entries), session_size(session_dir)))
+    with _lock:
+        connection = get_connection()
+        connection.executemany(
+            "DELETE FROM sessions WHERE character = ? AND session_name = ?",
+            [(char_name, session_name) for session_name in removed],
+        )
+        # Sessions written since are already in the index with a newer time
+        connection.executemany("INSERT OR IGNORE INTO sessions VALUES (?, ?, ?, ?, ?)", added)
+        connection.execute("INSERT OR REPLACE INTO character_dirs VALUES (?, ?)", (char_name, mtime_ns))
+        connection.commit()
+    if added or removed:
+        print(f"Session index of {char_name}: {len(added)} sessions added, {len(removed)} removed")
+
+
+def list_sessions(char_name: str, offset: int = 0, limit: int = 50) -> tuple[list[dict], int]:
+    """Sessions of a character, most recently updated first, and their total number."""
+    index_character(char_name)
+    with _lock:
+        connection = get_connection()
+        rows = connection.execute(
+            "SELECT session_name, updated_at, entry_count, size FROM sessions "
+            "WHERE character = ? ORDER BY updated_at DESC LIMIT ? OFFSET ?",
+            (char_name, limit, offset),
+        ).fetchall()
+        (total,) = connection.execute("SELECT COUNT(*) FROM sessions WHERE character = ?", (char_name,)).fetchone()
+    sessions = [
+        {"session_name": session_name, "updated_at": updated_at, "entry_count": entry_count, "size": size}
+        for session_name, updated_at, entry_count, size in rows
+    ]
+    return sessions, total
+
+
+def latest_session(char_name: str) -> str | None:
+    sessions, _ = list_sessions(char_name, limit=1)
+    return sessions[0]["session_name"] if sessions else None
+
+
+def close_session_index():
+    global _connection
+    with _lock:
+        if _connection is not None:
+            _connection.close()
+            _connection = None
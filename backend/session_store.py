@@ -0,0 +1,335 @@
+import asyncio
+import sqlite3
+import time
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from fastapi import APIRouter, HTTPException, Query
+from pydantic import BaseModel
+from settings import load_settings
+from session import (
+    MAX_JOURNAL_RECORDS,
+    JournalRecord,
+    Session,
+    SessionOp,
+    append_session_journal,
+    apply_record,
+    char_name_of,
+    read_session_records,
+    read_session_seq,
+    write_session,
+)
+from session_index import index_session, latest_session, list_sessions, remove_session
+
+router = APIRouter()
+
+# Number of sessions kept in memory, older ones are read from disk again when used
+MAX_CACHED_SESSIONS = 32
+
+DEFAULT_SESSION_WRITE_SETTINGS = {
+    # Seconds without a change before a session is written, saves in between are coalesced
+    "flush_delay": 1.0,
+    # Longest time a changed session waits to be written while it keeps changing
+    "max_flush_delay": 5.0,
+}
+
+
+@dataclass
+class SessionState:
+    """A session held by the server, updated with deltas instead of full uploads."""
+
+    session: Session
+    # Incremented by every delta, clients send the version they last saw
+    version: int = 0
+    # seq of the latest change, the next journal record takes seq + 1
+    seq: int = 0
+    # Records in the journal after the snapshot on disk
+    journal_records: int = 0
+    # Records not written yet, replaced by a snapshot when snapshot_due is set
+    pending: list[JournalRecord] = field(default_factory=list)
+    snapshot_due: bool = False
+    # time.monotonic() of the first and latest change not written, None when clean
+    dirty_since: float | None = None
+    changed_at: float = 0.0
+    # Debounce task waiting to write the session
+    flush_task: asyncio.Task | None = None
+    # Held while writing, so writes of a session stay in order
+    lock: asyncio.Lock = field(default_factory=asyncio.Lock)
+
+    def is_clean(self) -> bool:
+        return self.dirty_since is None and not self.lock.locked()
+
+
+_sessions: OrderedDict[str, SessionState] = OrderedDict()
+# Flushes running in the background
+_tasks: set[asyncio.Task] = set()
+_metrics = {
+    # Changes to sessions, each of which would have been a full write before
+    "saves": 0,
+    # Saves that joined a write already waiting for its debounce window
+    "coalesced": 0,
+    "snapshot_writes": 0,
+    "journal_writes": 0,
+    "failed_writes": 0,
+}
+
+
+def load_session_write_settings() -> dict:
+    return {**DEFAULT_SESSION_WRITE_SETTINGS, **load_settings().get("session_writes", {})}
+
+
+def session_key(char_name: str, session_name: str) -> str:
+    return f"{char_name}/{session_name}"
+
+
+def store_state(key: str, state: SessionState):
+    _sessions[key] = state
+    _sessions.move_to_end(key)
+    # Sessions not written yet stay, reading them from disk would lose changes
+    excess = len(_sessions) - MAX_CACHED_SESSIONS
+    for old_key in [old_key for old_key, old in _sessions.items() if old.is_clean()][: max(excess, 0)]:
+        del _sessions[old_key]
+
+
+async def get_session_state(key: str) -> SessionState:
+    state = _sessions.get(key)
+    if state is None:
+        char_name, _, session_name = key.rpartition("/")
+        # Reading replays the journal, and may truncate a torn record, so it runs in a thread
+        loaded = await asyncio.to_thread(read_session_records, char_name, session_name) if char_name else None
+        # Another request may have loaded or replaced the session meanwhile
+        state = _sessions.get(key)
+        if state is None:
+            if loaded is None:
+                raise HTTPException(status_code=404, detail=f"Session not found: {key}")
+            state = SessionState(loaded[0], journal_records=loaded[1], seq=loaded[2])
+    store_state(key, state)
+    return state
+
+
+async def get_session_at(key: str, version: int) -> SessionState:
+    state = await get_session_state(key)
+    if state.version != version:
+        raise HTTPException(
+            status_code=409, detail={"message": "Session version mismatch", "version": state.version}
+        )
+    return state
+
+
+def mark_dirty(state: SessionState, record: JournalRecord | None = None):
+    """Queue a change for writing, a full snapshot when no record is given."""
+    now = time.monotonic()
+    _metrics["saves"] += 1
+    if state.dirty_since is None:
+        state.dirty_since = now
+    else:
+        _metrics["coalesced"] += 1
+    state.changed_at = now
+    if record is None:
+        state.snapshot_due = True
+        state.pending = []
+    elif not state.snapshot_due:
+        state.pending.append(record)
+    schedule_flush(state)
+
+
+def schedule_flush(state: SessionState):
+    if state.flush_task is None:
+        state.flush_task = asyncio.create_task(flush_later(state))
+        _tasks.add(state.flush_task)
+        state.flush_task.add_done_callback(_tasks.discard)
+
+
+async def flush_later(state: SessionState):
+    settings = load_session_write_settings()
+    while state.dirty_since is not None:
+        deadline = min(state.changed_at + settings["flush_delay"], state.dirty_since + settings["max_flush_delay"])
+        delay = deadline - time.monotonic()
+        if delay <= 0:
+            break
+        await asyncio.sleep(delay)
+    # Changes made while writing start a new debounce window
+    state.flush_task = None
+    await flush_state(state)
+
+
+async def flush_state(state: SessionState) -> bool:
+    """Write the changes of a session in a thread, False if the write failed."""
+    async with state.lock:
+        if state.dirty_since is None:
+            return True
+        # Records created from here on take a higher seq than the snapshot
+        session, records, seq = state.session, state.pending, state.seq
+        snapshot = state.snapshot_due or state.journal_records + len(records) > MAX_JOURNAL_RECORDS
+        state.pending, state.snapshot_due, state.dirty_since = [], False, None
+        try:
+            if snapshot:
+                await asyncio.to_thread(write_session, session, seq)
+                state.journal_records = 0
+                _metrics["snapshot_writes"] += 1
+            else:
+                await asyncio.to_thread(append_session_journal, session, records)
+                state.journal_records += len(records)
+                _metrics["journal_writes"] += 1
+        except OSError as e:
+            print(f"Error writing session {char_name_of(session)}/{session.session_name}: {e}")
+            _metrics["failed_writes"] += 1
+            # Written again with the next flush, as a snapshot since the journal may hold part of it
+            state.pending, state.snapshot_due = [], True
+            if state.dirty_since is None:
+                state.dirty_since = state.changed_at = time.monotonic()
+            schedule_flush(state)
+            return False
+        try:
+            await asyncio.to_thread(index_session, session)
+        except sqlite3.Error as e:
+            print(f"Error indexing session {char_name_of(session)}/{session.session_name}: {e}")
+        return True
+
+
+async def flush_sessions(char_name: str | None = None) -> bool:
+    """Write every changed session now, or those of one character."""
+    states = [
+        state
+        for key, state in _sessions.items()
+        if char_name is None or key.rpartition("/")[0] == char_name
+    ]
+    results = await asyncio.gather(*(flush_state(state) for state in states))
+    return all(results)
+
+
+async def close_session_store():
+    """Write changed sessions before shutting down."""
+    for state in _sessions.values():
+        # Tasks still referenced by their state are waiting for the debounce window, not writing
+        if state.flush_task is not None:
+            state.flush_task.cancel()
+            state.flush_task = None
+    await asyncio.gather(*_tasks, return_exceptions=True)
+    await flush_sessions()
+
+
+async def replace_session(key: str, session: Session) -> SessionState:
+    state = _sessions.get(key)
+    if state is None:
+        # Continue the seq on disk, so records of a journal the snapshot replaces are never replayed on it
+        char_name, _, session_name = key.rpartition("/")
+        seq = await asyncio.to_thread(read_session_seq, char_name, session_name)
+        state = _sessions.get(key)
+    if state is None:
+        state = SessionState(session, seq=seq)
+    else:
+        # Replacing the content still moves the version on, so stale deltas are refused
+        state.session = session
+        state.version += 1
+    store_state(key, state)
+    mark_dirty(state)
+    return state
+
+
+class OpenSession(BaseModel):
+    character: str
+    session_name: str
+    # Full session to start from, when omitted it is read from disk
+    session: Session | None = None
+
+
+class SessionDelta(BaseModel):
+    session_id: str
+    version: int
+    ops: list[SessionOp]
+    system_token_count: int | None = None
+
+
+@router.post("/api/session/open")
+async def open_session(data: OpenSession):
+    key = session_key(data.character, data.session_name)
+    if data.session is not None:
+        if char_name_of(data.session) != data.character or data.session.session_name != data.session_name:
+            raise HTTPException(status_code=400, detail="Session does not match character and session_name")
+        state = await replace_session(key, data.session)
+    else:
+        state = await get_session_state(key)
+    return {"success": True, "session_id": key, "version": state.version}
+
+
+@router.post("/api/session/delta")
+async def update_session(delta: SessionDelta):
+    state = await get_session_at(delta.session_id, delta.version)
+    record = JournalRecord(seq=state.seq + 1, ops=delta.ops, system_token_count=delta.system_token_count)
+    state.session = apply_record(state.session, record)
+    state.seq = record.seq
+    state.version += 1
+    mark_dirty(state, record)
+    return {"success": True, "version": state.version}
+
+
+@router.post("/api/save-session")
+async def save_session(session: Session):
+    await replace_session(session_key(char_name_of(session), session.session_name), session)
+    return {"success": True}
+
+
+class FlushSessions(BaseModel):
+    # Character whose sessions are written, all sessions when omitted
+    character: str | None = None
+
+
+@router.post("/api/session/flush")
+async def flush_session_writes(data: FlushSessions):
+    return {"success": await flush_sessions(data.character)}
+
+
+@router.get("/api/session/metrics")
+async def session_write_metrics():
+    return {
+        **_metrics,
+        "dirty_sessions": sum(state.dirty_since is not None for state in _sessions.values()),
+        "cached_sessions": len(_sessions),
+    }
+
+
+class LoadSession(BaseModel):
+    name: str
+    session_name: str
+
+
+@router.post("/api/load-session")
+async def load_session(data: LoadSession):
+    try:
+        state = await get_session_state(session_key(data.name, data.session_name))
+    except HTTPException:
+        return {"success": False, "message": "Session not found"}
+    return {"success": True, "session": state.session.model_dump()}
+
+
+class LoadLastSession(BaseModel):
+    name: str
+
+
+@router.post("/api/load-last-session")
+async def load_last_session(data: LoadLastSession):
+    try:
+        # Pending sessions are written first, so the index has their latest time
+        await flush_sessions(data.name)
+        while True:
+            session_name = await asyncio.to_thread(latest_session, data.name)
+            if session_name is None:
+                return {"success": False, "message": "No sessions found for this character"}
+            try:
+                state = await get_session_state(session_key(data.name, session_name))
+            except HTTPException:
+                # Deleted from disk since it was indexed
+                await asyncio.to_thread(remove_session, data.name, session_name)
+                continue
+            return {"success": True, "session": state.session.model_dump(), "session_name": session_name}
+
+    except Exception as e:
+        print(f"Error loading last session: {e}")
+        return {"success": False, "message": str(e)}
+
+
+@router.get("/api/sessions")
+async def get_sessions(character: str, offset: int = 0, limit: int = Query(50, ge=1, le=500)):
+    await flush_sessions(character)
+    sessions, total = await asyncio.to_thread(list_sessions, character, max(offset, 0), limit)
+    return {"success": True, "sessions": sessions, "total": total, "offset": offset, "limit": limit}
@@ -1,12 +1,106 @@
 import json
 import pathlib
 import os
+import tempfile
+import threading
 from fastapi import APIRouter, HTTPException
 
 router = APIRouter()
+# Snapshot of settings.json returned by the last load_settings()
 settings = None
 
 
+class FrozenDict(dict):
+    """Read-only dict shared by every caller of a config snapshot."""
+
+    def _readonly(self, *args, **kwargs):
+        raise TypeError("config snapshots are read-only, copy them with dict() to modify")
+
+    __setitem__ = __delitem__ = clear = pop = popitem = setdefault = update = __ior__ = _readonly
+
+    def __copy__(self):
+        return dict(self)
+
+    def __deepcopy__(self, memo):
+        return thaw(self)
+
+
+class FrozenList(list):
+    def _readonly(self, *args, **kwargs):
+        raise TypeError("config snapshots are read-only, copy them with list() to modify")
+
+    __setitem__ = __delitem__ = __iadd__ = __imul__ = _readonly
+    append = extend = insert = pop = remove = clear = sort = reverse = _readonly
+
+    def __copy__(self):
+        return list(self)
+
+    def __deepcopy__(self, memo):
+        return thaw(self)
+
+
+def freeze(value):
+    if isinstance(value, dict):
+        return FrozenDict((key, freeze(item)) for key, item in value.items())
+    if isinstance(value, list):
+        return FrozenList(freeze(item) for item in value)
+    return value
+
+
+# Shared snapshot for config that does not apply to the current api
+EMPTY_SNAPSHOT = FrozenDict()
+
+
+def thaw(value):
+    if isinstance(value, dict):
+        return {key: thaw(item) for key, item in value.items()}
+    if isinstance(value, list):
+        return [thaw(item) for item in value]
+    return value
+
+
+# Parsed JSON files: path -> ((mtime_ns, size), snapshot)
+_snapshots: dict[str, tuple[tuple[int, int], FrozenDict]] = {}
+_snapshot_lock = threading.Lock()
+
+
+def file_version(path: str) -> tuple[int, int]:
+    stat = os.stat(path)
+    return stat.st_mtime_ns, stat.st_size
+
+
+def load_json_snapshot(path: str) -> FrozenDict:
+    """Parsed content of a JSON file, read again only when its mtime or size changes."""
+    version = file_version(path)
+    cached = _snapshots.get(path)
+    if cached is not None and cached[0] == version:
+        return cached[1]
+    with _snapshot_lock:
+        cached = _snapshots.get(path)
+        if cached is not None and cached[0] == version:
+            return cached[1]
+        with open(path, "r") as f:
+            snapshot = freeze(json.load(f))
+        _snapshots[path] = (version, snapshot)
+        return snapshot
+
+
+def save_json_snapshot(path: str, data: dict) -> FrozenDict:
+    """Write a JSON file atomically and make its content the current snapshot."""
+    snapshot = freeze(data)
+    with _snapshot_lock:
+        fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".tmp")
+        try:
+            with os.fdopen(fd, "w") as f:
+                json.dump(data, f, indent=2)
+            os.replace(temp_path, path)
+        except BaseException:
+            os.remove(temp_path)
+            raise
+        _snapshots[path] = (file_version(path), snapshot)
+    return snapshot
+
+
 def get_data_path(*subpaths):
     return os.path.join(str(pathlib.Path(__file__).parent.parent / "data"), *subpaths)
 
@@ -16,13 +110,15 @@ def get_preset_path(subpath):
 
 
 def load_settings(reload=False):
+    """Current snapshot of settings.json, re-read when the file changes or `reload` is set."""
     global settings
-    if settings is None or reload:
-        try:
-            with open(get_data_path("settings.json"), "r") as f:
-                settings = json.load(f)
-        except FileNotFoundError:
-            settings = {}
+    path = get_data_path("settings.json")
+    if reload:
+        _snapshots.pop(path, None)
+    try:
+        settings = load_json_snapshot(path)
+    except FileNotFoundError:
+        settings = EMPTY_SNAPSHOT
 
     return settings
 
@@ -43,49 +139,43 @@ def load_api_settings_for(api: str) -> dict:
 
 
 def load_preset():
-    settings = load_settings()
-    if settings["api_type"] == "infermaticai":
-        path = get_preset_path(settings["infermaticai"]["preset"])
-    elif settings["api_type"] == "openai":
-        path = get_preset_path(settings["openai"]["preset"])
-    elif settings["api_type"] == "googleaistudio":
-        path = get_preset_path(settings["googleaistudio"]["preset"])
-    with open(path, "r") as f:
-        return json.load(f)
+    return load_preset_for(load_settings()["api_type"])
 
 
 def load_preset_for(api: str) -> dict:
+    return load_json_snapshot(get_preset_path(load_settings()[api]["preset"]))
+
+
+def preset_paths_for(api: str) -> dict:
+    settings = load_settings()
+    paths = {
+        "preset": get_preset_path(settings[api]["preset"]),
+        "instruct": None,
+        "context": None,
+    }
     if api == "infermaticai":
-        path = get_preset_path(settings["infermaticai"]["preset"])
-    elif api == "openai":
-        path = get_preset_path(settings["openai"]["preset"])
-    elif api == "googleaistudio":
-        path = get_preset_path(settings["googleaistudio"]["preset"])
-    with open(path, "r") as f:
-        return json.load(f)
+        paths["instruct"] = get_preset_path(settings[api]["instruct"])
+        paths["context"] = get_preset_path(settings[api]["context"])
+    return paths
 
 
 def load_instruct():
     settings = load_settings()
     if settings["api_type"] == "infermaticai":
-        path = get_preset_path(settings["infermaticai"]["instruct"])
-        with open(path, "r") as f:
-            return json.load(f)
-    return {}
+        return load_json_snapshot(get_preset_path(settings["infermaticai"]["instruct"]))
+    return EMPTY_SNAPSHOT
 
 
 def load_context():
     settings = load_settings()
     if settings["api_type"] == "infermaticai":
-        path = get_preset_path(settings["infermaticai"]["context"])
-        with open(path, "r") as f:
-            return json.load(f)
-    return {}
+        return load_json_snapshot(get_preset_path(settings["infermaticai"]["context"]))
+    return EMPTY_SNAPSHOT
 
 
 @router.get("/api/settings")
 async def load_settings_api():
-    settings = load_settings(reload=True)
+    settings = load_settings()
     try:
         return {
             "settings": settings,
@@ -97,7 +187,6 @@ async def load_settings_api():
 
 @router.post("/api/save-settings")
 async def save_settings(data: dict):
-    with open(get_data_path("settings.json"), "w") as f:
-        json.dump(data, f, indent=2)
-    load_settings(reload=True)
+    global settings
+    settings = save_json_snapshot(get_data_path("settings.json"), data)
     return {"success": True}
@@ -0,0 +1,140 @@
+import asyncio
+import json
+import time
+from contextlib import aclosing
+
+try:
+    import orjson
+
+    loads = orjson.loads
+
+    def dumps(obj) -> bytes:
+        return orjson.dumps(obj)
+
+except ImportError:
+    loads = json.loads
+
+    def dumps(obj) -> bytes:
+        return json.dumps(obj).encode()
+
+
+# Constant framing of the events sent to the client, encoded once
+TEXT_FRAME_START = b'data: {"text": '
+TEXT_FRAME_END = b"}\n\n"
+EVENT_START = b"data: "
+EVENT_END = b"\n\n"
+
+
+def text_frame(text: str) -> bytes:
+    return TEXT_FRAME_START + dumps(text) + TEXT_FRAME_END
+
+
+def event_frame(data: dict) -> bytes:
+    return EVENT_START + dumps(data) + EVENT_END
+
+
+async def iter_until(items, timeout):
+    """Yield the items of an async iterator, and None each time timeout() seconds pass without one.
+
+    timeout() is asked again before every wait, None waits for the next item
+    however long it takes. The pending read is kept across timeouts, not
+    cancelled, so no item is lost.
+    """
+    items = aiter(items)
+    pending = None
+    try:
+        while True:
+            wait = timeout()
+            if pending is None:
+                if wait is None:
+                    # Nothing is due, read directly instead of paying for a task
+                    try:
+                        yield await anext(items)
+                    except StopAsyncIteration:
+                        return
+                    continue
+                pending = asyncio.ensure_future(anext(items))
+            done, _ = await asyncio.wait((pending,), timeout=wait)
+            if not done:
+                yield None
+                continue
+            task, pending = pending, None
+            try:
+                item = task.result()
+            except StopAsyncIteration:
+                return
+            yield item
+    finally:
+        if pending is not None:
+            pending.cancel()
+            await asyncio.gather(pending, return_exceptions=True)
+
+
+async def iter_lines(response, timeout=None):
+    """Yield the lines of a streamed response as bytes, without decoding them.
+
+    With a timeout (see iter_until), None is yielded whenever it expires
+    before more data arrives.
+    """
+    buffer = b""
+    chunks = response.aiter_bytes() if timeout is None else iter_until(response.aiter_bytes(), timeout)
+    async with aclosing(chunks):
+        async for chunk in chunks:
+            if chunk is None:
+                yield None
+                continue
+            buffer += chunk
+            lines = buffer.split(b"\n")
+            buffer = lines.pop()
+            for line in lines:
+                yield line.rstrip(b"\r")
+    if buffer:
+        yield buffer.rstrip(b"\r")
+
+
+class FrameCoalescer:
+    """Merges text deltas into fewer SSE frames.
+
+    The first delta is sent at once to keep time-to-first-token low. After
+    that, deltas are collected until `window_ms` has passed since the frame
+    was started or `max_chars` characters are pending. A window of 0 sends
+    every delta as its own frame. Pending text must be flushed once
+    timeout() expires even if no further delta arrives.
+    """
+
+    def __init__(self, window_ms: float = 15, max_chars: int = 512):
+        self.window = window_ms / 1000
+        self.max_chars = max_chars
+        self.pending = []
+        self.size = 0
+        self.frame_start = None
+        self.sent_first = False
+
+    def add(self, text: str) -> bytes | None:
+        self.pending.append(text)
+        self.size += len(text)
+        now = time.monotonic()
+        if self.frame_start is None:
+            self.frame_start = now
+        if not self.sent_first or now - self.frame_start >= self.window or self.size >= self.max_chars:
+            return self.flush()
+        return None
+
+    def timeout(self) -> float | None:
+        """Seconds until pending text is due, None when nothing is pending."""
+        if not self.pending:
+            return None
+        return max(0.0, self.frame_start + self.window - time.monotonic())
+
+    def flush(self) -> bytes | None:
+        if not self.pending:
+            return None
+        frame = text_frame("".join(self.pending))
+        self.clear()
+        self.sent_first = True
+        return frame
+
+    def clear(self):
+        self.pending = []
+        self.size = 0
+        self.frame_start = None
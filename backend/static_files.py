@@ -0,0 +1,97 @@
+import asyncio
+import hashlib
+import os
+import stat
+import threading
+from collections import OrderedDict
+from fastapi.staticfiles import StaticFiles
+from email.utils import formatdate
+from starlette.datastructures import Headers, QueryParams
+from starlette.responses import FileResponse, Response
+from starlette.staticfiles import NotModifiedResponse
+
+# Number of file hashes kept, files are hashed again when their mtime or size changes
+MAX_CACHED_HASHES = 1024
+# Larger files keep Starlette's ETag made of mtime and size instead of being read to hash them
+MAX_HASHED_SIZE = 64 * 1024 * 1024
+HASH_BLOCK_SIZE = 1024 * 1024
+
+# URLs carrying a version (?v=) change whenever the file does, so browsers keep them
+IMMUTABLE_CACHE_CONTROL = "public, max-age=31536000, immutable"
+# Other files are revalidated with their ETag, an unchanged file costs a 304
+REVALIDATE_CACHE_CONTROL = "no-cache"
+
+_hashes: OrderedDict[str, tuple[int, int, str]] = OrderedDict()
+_lock = threading.Lock()
+
+
+def content_hash(full_path: str, stat_result: os.stat_result | None = None) -> str | None:
+    """Hex sha256 prefix of a file's content, None for files over MAX_HASHED_SIZE."""
+    if stat_result is None:
+        stat_result = os.stat(full_path)
+    if stat_result.st_size > MAX_HASHED_SIZE:
+        return None
+    with _lock:
+        cached = _hashes.get(full_path)
+        if cached is not None and cached[:2] == (stat_result.st_mtime_ns, stat_result.st_size):
+            _hashes.move_to_end(full_path)
+            return cached[2]
+    digest = hashlib.sha256()
+    with open(full_path, "rb") as f:
+        while block := f.read(HASH_BLOCK_SIZE):
+            digest.update(block)
+    value = digest.hexdigest()[:16]
+    with _lock:
+        _hashes[full_path] = (stat_result.st_mtime_ns, stat_result.st_size, value)
+        _hashes.move_to_end(full_path)
+        while len(_hashes) > MAX_CACHED_HASHES:
+            _hashes.popitem(last=False)
+    return value
+
+
+def versioned_path(path: str, full_path: str) -> str:
+    """Path relative to /data with the version of its content, cached by browsers for good."""
+    version = content_hash(full_path)
+    return f"{path}?v={version}" if version is not None else path
+
+
+class DataFileResponse(FileResponse):
+    """FileResponse honouring If-Range with the ETag it is sent with.
+
+    Starlette compares If-Range with its own ETag, made of mtime and size,
+    so a content hash ETag would never match and ranges would always get
+    the whole file.
+    """
+
+    def _should_use_range(self, http_if_range: str, stat_result: os.stat_result) -> bool:
+        etag = self.headers.get("etag")
+        return http_if_range == formatdate(stat_result.st_mtime, usegmt=True) or (
+            etag is not None and http_if_range == etag
+        )
+
+
+class DataFiles(StaticFiles):
+    """StaticFiles with strong ETags from the file content and Cache-Control.
+
+    Conditional GET (If-None-Match) is handled by Starlette, Range requests
+    with If-Range by DataFileResponse, both using these ETags.
+    """
+
+    async def get_response(self, path: str, scope) -> Response:
+        # Hash outside of the event loop, file_response then finds it in the cache
+        full_path, stat_result = await asyncio.to_thread(self.lookup_path, path)
+        if stat_result is not None and stat.S_ISREG(stat_result.st_mode):
+            await asyncio.to_thread(content_hash, full_path, stat_result)
+        return await super().get_response(path, scope)
+
+    def file_response(self, full_path, stat_result: os.stat_result, scope, status_code: int = 200) -> Response:
+        request_headers = Headers(scope=scope)
+        versioned = "v" in QueryParams(scope["query_string"])
+        headers = {"cache-control": IMMUTABLE_CACHE_CONTROL if versioned else REVALIDATE_CACHE_CONTROL}
+        version = content_hash(str(full_path), stat_result)
+        if version is not None:
+            headers["etag"] = f'"{version}"'
+        response = DataFileResponse(full_path, status_code=status_code, stat_result=stat_result, headers=headers)
+        if self.is_not_modified(response.headers, request_headers):
+            return NotModifiedResponse(response.headers)
+        return response
@@ -1,97 +1,344 @@
-import json
+import asyncio
+import time
 import httpx
+from contextlib import aclosing
+from dataclasses import dataclass
+from http_client import get_client, get_limiter
+from tokenizer import StreamTokenCounter
+from settings import load_settings
+from payload import make_continuation_payload
+from sse_relay import FrameCoalescer, event_frame, iter_lines, loads
 from fastapi import HTTPException
 from fastapi.responses import StreamingResponse
-from html import unescape
+from starlette.background import BackgroundTask
 
 
-def unescape_text(text: str) -> str:
-    try:
-        # Handle JSON unicode escape sequences
-        text = json.loads(text)
-    except json.JSONDecodeError:
-        pass  # If not valid JSON string, keep original
-    return unescape(text.replace("\\n", "\n"))
-
-
-async def stream_post(url: str, api_key: str | None, payload: dict, openai: bool = True, start_index: int = 0):
-    async def generate():
-        async with httpx.AsyncClient() as client:
-            max_retries = 3
-            retry_count = 0
-
-            while retry_count < max_retries:
-                try:
-                    headers = (
-                        {
-                            "Authorization": f"Bearer {api_key}",
-                            "Content-Type": "application/json",
-                        }
-                        if api_key is not None
-                        else {
-                            "Content-Type": "application/json",
-                        }
+def completion_tokens(json_data: dict) -> int | None:
+    """Completion token count from the usage field of a stream chunk, if any."""
+    usage = json_data.get("usage")
+    if usage:
+        return usage.get("completion_tokens")
+    usage = json_data.get("usageMetadata")
+    if usage:
+        # Thinking tokens are counted separately in thoughtsTokenCount
+        return usage.get("candidatesTokenCount")
+    return None
+
+
+def chunk_texts(json_data: dict, openai: bool) -> tuple[list[str], list[str]]:
+    """Reply text and thought text carried by one stream chunk."""
+    candidates = json_data.get("candidates")
+    if candidates is not None:
+        # Gemini: a chunk may hold several parts, thoughts are flagged per part
+        texts = []
+        thoughts = []
+        content = candidates[0].get("content") if candidates else None
+        for part in (content or {}).get("parts") or []:
+            text = part.get("text")
+            if text:
+                (thoughts if part.get("thought") else texts).append(text)
+        return texts, thoughts
+    choices = json_data.get("choices") or []
+    if len(choices) == 0:
+        return [], []
+    if openai:
+        text = choices[0].get("delta", {}).get("content")
+    else:
+        text = choices[0].get("text")
+    return ([text] if text else []), []
+
+
+def make_coalescer() -> FrameCoalescer:
+    relay = load_settings().get("relay", {})
+    return FrameCoalescer(relay.get("frame_ms", 15), relay.get("frame_chars", 512))
+
+
+def load_retry_settings() -> dict:
+    return {
+        "max_retries": 3,
+        # Continue from the partial reply instead of regenerating it
+        "resume": True,
+        # Seconds before the first retry, doubled on each further retry
+        "backoff": 0.5,
+        "backoff_max": 8,
+        **load_settings().get("retry", {}),
+    }
+
+
+@dataclass
+class UpstreamRequest:
+    """One streamed completion request to a provider."""
+
+    url: str
+    api_key: str | None
+    payload: dict
+    openai: bool = True
+    start_index: int = 0
+    prefix_stable: bool | None = None
+    token_counter: StreamTokenCounter | None = None
+    # Resume a chat with vLLM's continue_final_message, only for servers that accept it
+    continue_final_message: bool = False
+    # Name of the provider and model in the logs
+    label: str = ""
+
+
+async def end_event(request: UpstreamRequest, usage_tokens: int | None) -> bytes:
+    # Sent when the stream ends
+    end_data = {"start_index": request.start_index}
+    if request.prefix_stable is not None:
+        end_data["prefix_stable"] = request.prefix_stable
+    # token_count is counted like the session's other entries, it is left out when that cannot be done locally
+    if request.token_counter is not None:
+        end_data["token_count"] = await request.token_counter.total()
+    # The provider's own count, when it reports usage
+    if usage_tokens is not None:
+        end_data["usage_tokens"] = usage_tokens
+    return event_frame(end_data)
+
+
+async def relay(request: UpstreamRequest):
+    """Stream the request and yield the SSE frames sent to the client."""
+    url = request.url
+    api_key = request.api_key
+    payload = request.payload
+    token_counter = request.token_counter
+    client = get_client(url)
+    coalescer = make_coalescer()
+    retry = load_retry_settings()
+    max_retries = retry["max_retries"]
+    retry_count = 0
+    usage_tokens = None
+    request_payload = payload
+    # Text relayed so far, sent back as a prefill when resuming
+    partial = []
+    resumed = False
+    started = time.monotonic()
+    first_token = True
+
+    def relay_text(text: str) -> bytes | None:
+        partial.append(text)
+        if token_counter is not None:
+            token_counter.feed(text)
+        return coalescer.add(text)
+
+    def log_first_token():
+        nonlocal first_token
+        if first_token:
+            first_token = False
+            print(f"TTFT {request.label or url}: {(time.monotonic() - started) * 1000:.0f} ms")
+
+    while retry_count < max_retries:
+        try:
+            headers = (
+                {
+                    "Authorization": f"Bearer {api_key}",
+                    "Content-Type": "application/json",
+                }
+                if api_key is not None
+                else {
+                    "Content-Type": "application/json",
+                }
+            )
+            async with client.stream(
+                "POST",
+                url,
+                headers=headers,
+                json=request_payload,
+            ) as response:
+                print(f"response: {response}")
+                # print(f"response headers: {response.headers}")
+                if response.status_code != 200:
+                    raise HTTPException(
+                        status_code=response.status_code,
+                        detail="API request failed",
+                    )
+
+                # OpenAI-compatible servers end with [DONE], Gemini (alt=sse) just closes the stream
+                # Pending text is flushed when its window ends, not when the next line arrives
+                async with aclosing(iter_lines(response, coalescer.timeout)) as lines:
+                    async for line in lines:
+                        if line is None:
+                            if frame := coalescer.flush():
+                                yield frame
+                            continue
+                        if not line.startswith(b"data: "):
+                            continue
+                        data = line[6:]
+                        if data == b"[DONE]":
+                            break
+                        try:
+                            json_data = loads(data)
+                        except ValueError:
+                            continue
+                        usage_tokens = completion_tokens(json_data) or usage_tokens
+                        texts, thoughts = chunk_texts(json_data, request.openai)
+                        for thought in thoughts:
+                            log_first_token()
+                            yield event_frame({"thought": thought})
+                        for text in texts:
+                            if frame := relay_text(text):
+                                log_first_token()
+                                yield frame
+
+                if frame := coalescer.flush():
+                    yield frame
+                # After a resume the provider's usage only covers the last request
+                yield await end_event(request, None if resumed else usage_tokens)
+        except httpx.TimeoutException as e:
+            retry_count += 1
+            if retry_count == max_retries:
+                raise HTTPException(
+                    status_code=504,
+                    detail=f"Timeout after {max_retries} retries: {str(e)}",
+                )
+            usage_tokens = None
+            if retry["resume"]:
+                print(f"Timeout occurred. Resuming after {sum(map(len, partial))} characters... ({retry_count}/{max_retries})")
+                if frame := coalescer.flush():
+                    yield frame
+                if partial:
+                    used_tokens = await token_counter.total() if token_counter is not None else None
+                    request_payload = make_continuation_payload(
+                        payload, "".join(partial), used_tokens, request.continue_final_message
                     )
-                    async with client.stream(
-                        "POST",
-                        url,
-                        headers=headers,
-                        json=payload,
-                        timeout=60.0,
-                    ) as response:
-                        print(f"response: {response}")
-                        # print(f"response headers: {response.headers}")
-                        if response.status_code != 200:
-                            raise HTTPException(
-                                status_code=response.status_code,
-                                detail="API request failed",
-                            )
-
-                        async for line in response.aiter_lines():
-                            if line.startswith("data: "):
-                                data = line[6:]
-                                if data == "[DONE]":
-                                    # Send the start_index when stream ends
-                                    yield f"data: {json.dumps({'start_index': start_index})}\n\n"
-                                    break
-                                try:
-                                    json_data = json.loads(data)
-                                    choices = json_data.get("choices")
-                                    if len(choices) == 0:
-                                        continue
-                                    if openai:
-                                        text = choices[0].get("delta", {}).get("content")
-                                        if text:
-                                            yield f"data: {json.dumps({'text': text})}\n\n"
-                                    else:
-                                        text = choices[0].get("text")
-                                        if text:
-                                            yield f"data: {json.dumps({'text': text})}\n\n"
-                                except json.JSONDecodeError:
-                                    continue
-                            else:
-                                try:
-                                    if '"text": ' in line:
-                                        text = line.split('"text": ')[1].strip()
-                                        if text.endswith(","):
-                                            text = text[:-1]
-                                        text = unescape_text(text)
-                                        yield f"data: {json.dumps({'text': text})}\n\n"
-                                    elif line == "]":
-                                        yield f"data: {json.dumps({'start_index': start_index})}\n\n"
-                                        break
-                                except Exception:
-                                    continue
-                except httpx.TimeoutException as e:
-                    retry_count += 1
-                    if retry_count == max_retries:
-                        raise HTTPException(
-                            status_code=504,
-                            detail=f"Timeout after {max_retries} retries: {str(e)}",
-                        )
-                    print(f"Timeout occurred. Retrying... ({retry_count}/{max_retries})")
-                    yield f"data: {json.dumps({'reset': True})}\n\n"
+                    resumed = True
+            else:
+                print(f"Timeout occurred. Retrying... ({retry_count}/{max_retries})")
+                partial.clear()
+                coalescer.clear()
+                if token_counter is not None:
+                    token_counter.reset()
+                yield event_frame({"reset": True})
+            await asyncio.sleep(min(retry["backoff"] * 2 ** (retry_count - 1), retry["backoff_max"]))
+            continue
+        break
+
+
+async def limited_relay(request: UpstreamRequest, release=None):
+    """relay() holding a slot of the provider's limiter, acquired here unless `release` is given."""
+    if release is None:
+        release = await get_limiter(request.url, request.api_key).acquire()
+    frames = relay(request)
+    try:
+        async for frame in frames:
+            yield frame
+    finally:
+        try:
+            # Closing the relay leaves the client.stream context, which aborts the upstream request
+            await frames.aclose()
+        finally:
+            # Released even when the close is cancelled by a client disconnect
+            release()
+
+
+async def pump_frames(index: int, frames, queue: asyncio.Queue):
+    """Put the frames of one stream into queue as (index, frame, None), then (index, None, error or None)."""
+    async with aclosing(frames):
+        try:
+            async for frame in frames:
+                await queue.put((index, frame, None))
+        except Exception as e:
+            await queue.put((index, None, e))
+            return
+        await queue.put((index, None, None))
+
+
+async def hedged_relay(primary: UpstreamRequest, secondary: UpstreamRequest, delay_ms: float, release):
+    """Relay the primary request, racing the secondary one if the primary is silent for delay_ms.
+
+    Each stream is read by its own task into a shared queue. The first stream
+    to produce a frame is relayed and the other is cancelled.
+    """
+    # Small, so the relayed stream is only read as fast as the client takes it
+    queue = asyncio.Queue(maxsize=8)
+    requests = [primary]
+    started = [time.monotonic()]
+    tasks = [asyncio.create_task(pump_frames(0, limited_relay(primary, release), queue))]
+
+    def start_hedge():
+        requests.append(secondary)
+        started.append(time.monotonic())
+        tasks.append(asyncio.create_task(pump_frames(1, limited_relay(secondary), queue)))
+
+    try:
+        winner = None
+        failed = set()
+        while True:
+            timeout = None
+            if len(tasks) == 1:
+                timeout = max(0.0, delay_ms / 1000 - (time.monotonic() - started[0]))
+            try:
+                index, frame, error = await asyncio.wait_for(queue.get(), timeout)
+            except asyncio.TimeoutError:
+                print(f"No output from {primary.label} after {delay_ms:.0f} ms, hedging with {secondary.label}")
+                start_hedge()
+                continue
+
+            if winner is None:
+                if frame is not None:
+                    winner = index
+                    for i, task in enumerate(tasks):
+                        if i != winner and i not in failed:
+                            task.cancel()
+                            print(f"Cancelled {requests[i].label} after {(time.monotonic() - started[i]) * 1000:.0f} ms")
+                else:
+                    error = error or HTTPException(status_code=502, detail="Empty response")
+                    print(f"{requests[index].label} failed: {error!r}")
+                    failed.add(index)
+                    if len(tasks) == 1:
+                        # The primary failed before the hedge delay, start the hedge at once
+                        start_hedge()
+                    elif len(failed) == len(tasks):
+                        raise error
                     continue
-                break
+            if index != winner:
+                continue
+            if error is not None:
+                raise error
+            if frame is None:
+                return
+            yield frame
+    finally:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+
+async def close_on_disconnect(frames):
+    try:
+        async for frame in frames:
+            yield frame
+    except (asyncio.CancelledError, GeneratorExit):
+        print("Client disconnected, cancelling the upstream request")
+        raise
+    finally:
+        await frames.aclose()
+
+
+async def stream_upstream(request: UpstreamRequest, hedge: UpstreamRequest | None = None, hedge_delay_ms: float = 0):
+    # Wait for a free slot before answering, so a full queue surfaces as a 429
+    release = await get_limiter(request.url, request.api_key).acquire()
+    if hedge is None:
+        frames = limited_relay(request, release)
+    else:
+        frames = hedged_relay(request, hedge, hedge_delay_ms, release)
+    # Also released after the response, in case the stream never started
+    return StreamingResponse(
+        close_on_disconnect(frames),
+        media_type="text/event-stream",
+        background=BackgroundTask(release),
+    )
+
 
-    return StreamingResponse(generate(), media_type="text/event-stream")
+async def stream_post(
+    url: str,
+    api_key: str | None,
+    payload: dict,
+    openai: bool = True,
+    start_index: int = 0,
+    prefix_stable: bool | None = None,
+    token_counter: StreamTokenCounter | None = None,
+):
+    return await stream_upstream(
+        UpstreamRequest(url, api_key, payload, openai, start_index, prefix_stable, token_counter)
+    )
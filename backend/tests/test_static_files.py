@@ -0,0 +1,44 @@
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from fastapi import FastAPI  # noqa: E402
+from fastapi.testclient import TestClient  # noqa: E402
+from static_files import IMMUTABLE_CACHE_CONTROL, REVALIDATE_CACHE_CONTROL, DataFiles  # noqa: E402
+
+CONTENT = bytes(range(256)) * 16
+
+
+def make_client(tmp_path) -> TestClient:
+    (tmp_path / "image.png").write_bytes(CONTENT)
+    app = FastAPI()
+    app.mount("/data", DataFiles(directory=tmp_path), name="data")
+    return TestClient(app)
+
+
+def test_etag_and_cache_control(tmp_path):
+    client = make_client(tmp_path)
+    response = client.get("/data/image.png")
+    assert response.status_code == 200
+    assert response.headers["cache-control"] == REVALIDATE_CACHE_CONTROL
+    assert client.get("/data/image.png?v=1").headers["cache-control"] == IMMUTABLE_CACHE_CONTROL
+
+    not_modified = client.get("/data/image.png", headers={"if-none-match": response.headers["etag"]})
+    assert not_modified.status_code == 304
+
+
+def test_range_with_matching_if_range(tmp_path):
+    client = make_client(tmp_path)
+    etag = client.get("/data/image.png").headers["etag"]
+    response = client.get("/data/image.png", headers={"range": "bytes=0-9", "if-range": etag})
+    assert response.status_code == 206
+    assert response.content == CONTENT[:10]
+    assert response.headers["content-range"] == f"bytes 0-9/{len(CONTENT)}"
+
+
+def test_range_with_stale_if_range(tmp_path):
+    client = make_client(tmp_path)
+    response = client.get("/data/image.png", headers={"range": "bytes=0-9", "if-range": '"stale"'})
+    assert response.status_code == 200
+    assert response.content == CONTENT
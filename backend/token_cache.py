@@ -0,0 +1,57 @@
+import hashlib
+import sqlite3
+import threading
+from settings import get_data_path
+
+# Token counts keyed by (tokenizer id, sha1 of the counted text), kept across restarts
+_connection = None
+_lock = threading.Lock()
+
+
+def get_connection() -> sqlite3.Connection:
+    global _connection
+    if _connection is None:
+        _connection = sqlite3.connect(get_data_path("token_cache.db"), check_same_thread=False)
+        _connection.execute(
+            "CREATE TABLE IF NOT EXISTS token_counts ("
+            "tokenizer TEXT NOT NULL, hash TEXT NOT NULL, count INTEGER NOT NULL, "
+            "PRIMARY KEY (tokenizer, hash))"
+        )
+        _connection.commit()
+    return _connection
+
+
+def content_hash(text: str) -> str:
+    return hashlib.sha1(text.encode("utf-8")).hexdigest()
+
+
+def get_cached_counts(tokenizer_id: str, texts: list[str]) -> list[int | None]:
+    hashes = [content_hash(text) for text in texts]
+    found = {}
+    with _lock:
+        connection = get_connection()
+        # Stay well below SQLite's host parameter limit
+        for i in range(0, len(hashes), 500):
+            chunk = hashes[i : i + 500]
+            rows = connection.execute(
+                f"SELECT hash, count FROM token_counts WHERE tokenizer = ? AND hash IN ({','.join('?' * len(chunk))})",
+                [tokenizer_id, *chunk],
+            )
+            found.update(rows)
+    return [found.get(h) for h in hashes]
+
+
+def store_counts(tokenizer_id: str, texts: list[str], counts: list[int]):
+    rows = [(tokenizer_id, content_hash(text), count) for text, count in zip(texts, counts)]
+    with _lock:
+        connection = get_connection()
+        connection.executemany("INSERT OR REPLACE INTO token_counts VALUES (?, ?, ?)", rows)
+        connection.commit()
+
+
+def close_token_cache():
+    global _connection
+    with _lock:
+        if _connection is not None:
+            _connection.close()
+            _connection = None
@@ -1,18 +1,34 @@
+import asyncio
+import fnmatch
+import json
+import os
+import threading
 from fastapi import APIRouter
 from pydantic import BaseModel
-import httpx
-from settings import load_api_settings, load_settings, load_preset
-from chat_common import ChatEntry, CharInfo
+from settings import get_data_path, load_api_settings, load_settings
+from prompt_plan import load_prompt_plan
+from chat_common import ChatEntry, CharInfo, ChatMessage, TokenLedger, get_token_ledger
 from prompt import make_prompt, make_prompt_single
 from prompt_openai import make_openai_prompt
+from http_client import get_client, INFERMATICAI_URL
+from token_cache import get_cached_counts, store_counts
 import transformers
 
 router = APIRouter()
 
 # Initialize tokenizer globally
 chat_tokenizer_dir = "./deepseek_v3_tokenizer/"
+chat_tokenizer_id = "deepseek_v3"
 _tokenizer = None
 
+# Tokenizers of text completion models, loaded from data/tokenizers/ on first use
+_model_tokenizers: dict[str, tuple[str, object] | None] = {}
+_model_tokenizers_lock = threading.Lock()
+
+# Remote token counter calls in flight at once, a batch of entries is counted a few at a time
+MAX_REMOTE_COUNTS = 8
+_remote_counts = asyncio.Semaphore(MAX_REMOTE_COUNTS)
+
 
 def get_tokenizer():
     global _tokenizer
@@ -21,115 +37,318 @@ def get_tokenizer():
     return _tokenizer
 
 
+def find_model_tokenizer_dir(model: str) -> str | None:
+    """Find the tokenizer shipped for `model` under data/tokenizers/.
+
+    data/tokenizers/registry.json may map model name patterns (fnmatch, case
+    insensitive) to tokenizer directories. Otherwise a directory named after
+    the model, with "/" replaced by "--", is used.
+    """
+    tokenizers_dir = get_data_path("tokenizers")
+    registry_path = os.path.join(tokenizers_dir, "registry.json")
+    if os.path.exists(registry_path):
+        with open(registry_path, "r") as f:
+            registry = json.load(f)
+        for pattern, dir_name in registry.items():
+            if fnmatch.fnmatch(model.lower(), pattern.lower()):
+                return os.path.join(tokenizers_dir, dir_name)
+    path = os.path.join(tokenizers_dir, model.replace("/", "--"))
+    if os.path.isdir(path):
+        return path
+    return None
+
+
+def get_model_tokenizer(model: str) -> tuple[str, object] | None:
+    """Return (tokenizer id, tokenizer) for `model`, loading it on first use."""
+    with _model_tokenizers_lock:
+        if model not in _model_tokenizers:
+            path = find_model_tokenizer_dir(model)
+            if path is None:
+                _model_tokenizers[model] = None
+            else:
+                tokenizer = transformers.AutoTokenizer.from_pretrained(path, trust_remote_code=True)
+                _model_tokenizers[model] = (os.path.basename(os.path.normpath(path)), tokenizer)
+        return _model_tokenizers[model]
+
+
+def count_texts_cached(tokenizer_id: str, load_tokenizer, texts: list[str]) -> list[int]:
+    """Count tokens of many texts with one batch call of a fast tokenizer.
+
+    Counts are looked up in the persistent token cache first, so only texts
+    never seen before are encoded. Blocking; run it on a worker thread.
+    """
+    if not texts:
+        return []
+    counts = get_cached_counts(tokenizer_id, texts)
+    missing = [text for text, count in zip(texts, counts) if count is None]
+    if missing:
+        encoded = load_tokenizer()(missing)
+        missing_counts = [len(ids) for ids in encoded["input_ids"]]
+        store_counts(tokenizer_id, missing, missing_counts)
+        missing_iter = iter(missing_counts)
+        counts = [count if count is not None else next(missing_iter) for count in counts]
+    return counts
+
+
+def count_texts_local(texts: list[str]) -> list[int]:
+    return count_texts_cached(chat_tokenizer_id, get_tokenizer, texts)
+
+
+async def count_text_remote(prompt: str, settings: dict) -> int:
+    client = get_client(INFERMATICAI_URL)
+    async with _remote_counts:
+        response = await client.post(
+            f"{INFERMATICAI_URL}/utils/token_counter",
+            json={"model": settings["model"], "prompt": prompt},
+            headers={
+                "Authorization": f"Bearer {settings['api_key']}",
+                "Content-Type": "application/json",
+            },
+        )
+    if response.status_code != 200:
+        raise RuntimeError(f"Token counter returned {response.status_code}: {response.text[:200]}")
+    result = response.json()
+    print(result)
+    if not isinstance(result.get("total_tokens"), int):
+        raise RuntimeError(f"Token counter returned no count: {result}")
+    return result["total_tokens"]
+
+
+async def count_texts_infermaticai(prompts: list[str], settings: dict) -> list[int]:
+    """Count with the model's local tokenizer, or the remote token counter if there is none."""
+    model = settings["model"]
+    model_tokenizer = await asyncio.to_thread(get_model_tokenizer, model)
+    if model_tokenizer is not None:
+        tokenizer_id, tokenizer = model_tokenizer
+        return await asyncio.to_thread(count_texts_cached, tokenizer_id, lambda: tokenizer, prompts)
+
+    tokenizer_id = f"totalgpt:{model}"
+    counts = await asyncio.to_thread(get_cached_counts, tokenizer_id, prompts)
+    missing = [prompt for prompt, count in zip(prompts, counts) if count is None]
+    if missing:
+        results = await asyncio.gather(
+            *(count_text_remote(prompt, settings) for prompt in missing), return_exceptions=True
+        )
+        # Keep the counts that succeeded, failed ones are asked again next time
+        counted = [(prompt, count) for prompt, count in zip(missing, results) if isinstance(count, int)]
+        if counted:
+            await asyncio.to_thread(
+                store_counts, tokenizer_id, [prompt for prompt, _ in counted], [count for _, count in counted]
+            )
+        for result in results:
+            if isinstance(result, BaseException):
+                raise result
+        missing_counts = list(results)
+        missing_iter = iter(missing_counts)
+        counts = [count if count is not None else next(missing_iter) for count in counts]
+    return counts
+
+
+async def count_entries(entries: list[ChatEntry], user: str) -> list[int]:
+    settings = load_settings()
+    if settings["api_type"] == "infermaticai":
+        prompts = [make_prompt_single(user, entry) for entry in entries]
+        return await count_texts_infermaticai(prompts, load_api_settings())
+    return await asyncio.to_thread(count_texts_local, [entry.content for entry in entries])
+
+
+def get_counting_tokenizer_id() -> str:
+    """Id of the tokenizer count_entries uses with the current settings."""
+    if load_settings()["api_type"] == "infermaticai":
+        model = load_api_settings()["model"]
+        path = find_model_tokenizer_dir(model)
+        tokenizer_id = os.path.basename(os.path.normpath(path)) if path is not None else f"totalgpt:{model}"
+        # Entries are counted wrapped in the instruct template
+        return f"infermaticai:{tokenizer_id}"
+    return chat_tokenizer_id
+
+
+class StreamTokenCounter:
+    """Counts the tokens of a reply while it is being streamed.
+
+    Every complete line is tokenized in a background task as soon as it
+    arrives, so when the stream ends only the last line is left to count.
+    Lines are counted without special tokens, which are added once together
+    with the entry's wrapping (instruct sequences) at the end.
+    """
+
+    def __init__(self, load_tokenizer, prefix: str = "", suffix: str = ""):
+        self.load_tokenizer = load_tokenizer
+        self.prefix = prefix
+        self.suffix = suffix
+        self.pending = []
+        self.count = 0
+        self.task = None
+
+    def count_plain(self, text: str) -> int:
+        return len(self.load_tokenizer()(text, add_special_tokens=False)["input_ids"])
+
+    def feed(self, text: str):
+        self.pending.append(text)
+        if "\n" in text and (self.task is None or self.task.done()):
+            self.task = asyncio.create_task(self.count_lines())
+
+    async def count_lines(self):
+        text = "".join(self.pending)
+        cut = text.rfind("\n") + 1
+        self.pending = [text[cut:]]
+        self.count += await asyncio.to_thread(self.count_plain, text[:cut])
+
+    def reset(self):
+        if self.task is not None:
+            self.task.cancel()
+        self.task = None
+        self.pending = []
+        self.count = 0
+
+    async def total(self) -> int | None:
+        try:
+            while self.task is not None and not self.task.done():
+                await self.task
+            tail = "".join(self.pending)
+            wrapping = await asyncio.to_thread(
+                lambda: len(self.load_tokenizer()(self.prefix + self.suffix)["input_ids"]) + self.count_plain(tail)
+            )
+            return self.count + wrapping
+        except Exception as e:
+            print(f"Error counting streamed tokens: {e}")
+            return None
+
+
+def make_stream_token_counter(api: str, settings: dict) -> StreamTokenCounter | None:
+    """Counter matching how the entry of a streamed reply is counted for `api` with its api settings.
+
+    None when entries are counted by the remote token counter, which cannot
+    count a stream; the client then counts the reply with the other entries.
+    """
+    if api == "infermaticai":
+        model = settings["model"]
+        if find_model_tokenizer_dir(model) is None:
+            return None
+        instruct = load_prompt_plan("infermaticai").instruct
+        return StreamTokenCounter(
+            lambda: get_model_tokenizer(model)[1], instruct["output_sequence"], instruct["output_suffix"]
+        )
+    return StreamTokenCounter(get_tokenizer)
+
+
+async def load_token_ledger(message: ChatMessage, user: str) -> TokenLedger:
+    """Bring the session's token ledger up to date with message.entries.
+
+    Entries the client has not counted yet are counted here in one batch, and
+    their token_count is filled in. Requests of the same session update the
+    ledger one at a time, and each gets a copy matching its own entries.
+    When the api or model now counts with another tokenizer, every entry is
+    counted again.
+    """
+    ledger = get_token_ledger(message.session_id())
+    entries = message.entries
+    async with ledger.lock:
+        tokenizer_id = await asyncio.to_thread(get_counting_tokenizer_id)
+        if ledger.tokenizer_id is not None and ledger.tokenizer_id != tokenizer_id:
+            ledger.update([], 0)
+            for entry in entries:
+                entry.token_count = None
+        ledger.tokenizer_id = tokenizer_id
+        start = ledger.first_changed(entries)
+        for i in range(start):
+            if entries[i].token_count is None:
+                entries[i].token_count = ledger.counts[i]
+        missing = [entry for entry in entries[start:] if entry.token_count is None]
+        if missing:
+            counts = await count_entries(missing, user)
+            for entry, count in zip(missing, counts):
+                entry.token_count = count
+        ledger.update(entries, start)
+        return ledger.copy()
+
+
 class TokenMessage(BaseModel):
     system_prompt: bool
     info: CharInfo
     entry: ChatEntry
 
 
+class TokenBatchMessage(BaseModel):
+    system_prompt: bool = False
+    info: CharInfo
+    entries: list[ChatEntry]
+    # First entry of the story, the text completion system prompt is counted with it
+    first_entry: ChatEntry | None = None
+
+
+def make_system_prompt_infermaticai(info: CharInfo, entry: ChatEntry) -> str:
+    wiBefore = ""
+    wiAfter = ""
+    persona = "Julien is living alone in a luxury mansion."
+    return make_prompt(
+        "Julien",
+        info.name,
+        wiBefore,
+        info.description,
+        info.personality,
+        info.scenario,
+        wiAfter,
+        persona,
+        [entry],
+        0,
+    )
+
+
+def make_system_prompt_texts(info: CharInfo) -> list[str]:
+    plan = load_prompt_plan()
+    persona = "Julien is living alone in a luxury mansion."
+    messages = make_openai_prompt(
+        "Julien",
+        info.name,
+        "",
+        info.description,
+        info.personality,
+        info.scenario,
+        info.mes_example,
+        "",
+        persona,
+        [],
+        0,
+        plan,
+    )
+    return [msg["content"] for msg in messages]
+
+
 async def count_tokens_infermaticai(message: TokenMessage):
     try:
         settings = load_api_settings()
-        wiBefore = ""
-        wiAfter = ""
-        persona = "Julien is living alone in a luxury mansion."
         if message.system_prompt:
-            prompt = make_prompt(
-                "Julien",
-                message.info.name,
-                wiBefore,
-                message.info.description,
-                message.info.personality,
-                message.info.scenario,
-                wiAfter,
-                persona,
-                [message.entry],
-                0,
-            )
+            prompt = make_system_prompt_infermaticai(message.info, message.entry)
         else:
             prompt = make_prompt_single("Julien", message.entry)
-        async with httpx.AsyncClient() as client:
-            response = await client.post(
-                "https://api.totalgpt.ai/utils/token_counter",
-                json={"model": settings["model"], "prompt": prompt},
-                headers={
-                    "Authorization": f"Bearer {settings['api_key']}",
-                    "Content-Type": "application/json",
-                },
-            )
-            result = response.json()
-            print(result)
-            return {"success": True, "total_tokens": result["total_tokens"]}
+        total_tokens = (await count_texts_infermaticai([prompt], settings))[0]
+        return {"success": True, "total_tokens": total_tokens}
 
     except Exception as e:
         print(f"Error counting tokens: {e}")
         return {"success": False, "message": str(e)}
 
 
-async def count_tokens_openai(message: TokenMessage):
+async def count_tokens_local(message: TokenMessage):
     try:
-        tokenizer = get_tokenizer()
         if message.system_prompt:
-            preset = load_preset()
-            persona = "Julien is living alone in a luxury mansion."
-            messages = make_openai_prompt(
-                "Julien",
-                message.info.name,
-                "",
-                message.info.description,
-                message.info.personality,
-                message.info.scenario,
-                message.info.mes_example,
-                "",
-                persona,
-                [],
-                0,
-                preset,
-            )
-            total_tokens = 0
-            for msg in messages:
-                tokens = tokenizer.encode(msg["content"])
-                total_tokens += len(tokens)
+            texts = make_system_prompt_texts(message.info)
         else:
-            tokens = tokenizer.encode(message.entry.content)
-            total_tokens = len(tokens)
-        return {"success": True, "total_tokens": total_tokens}
+            texts = [message.entry.content]
+        counts = await asyncio.to_thread(count_texts_local, texts)
+        return {"success": True, "total_tokens": sum(counts)}
     except Exception as e:
         print(f"Error counting tokens: {e}")
         return {"success": False, "message": str(e)}
 
 
+async def count_tokens_openai(message: TokenMessage):
+    return await count_tokens_local(message)
+
+
 async def count_tokens_googleaistudio(message: TokenMessage):
-    try:
-        tokenizer = get_tokenizer()
-        if message.system_prompt:
-            preset = load_preset()
-            persona = "Julien is living alone in a luxury mansion."
-            messages = make_openai_prompt(
-                "Julien",
-                message.info.name,
-                "",
-                message.info.description,
-                message.info.personality,
-                message.info.scenario,
-                message.info.mes_example,
-                "",
-                persona,
-                [],
-                0,
-                preset,
-            )
-            total_tokens = 0
-            for msg in messages:
-                tokens = tokenizer.encode(msg["content"])
-                total_tokens += len(tokens)
-        else:
-            tokens = tokenizer.encode(message.entry.content)
-            total_tokens = len(tokens)
-        return {"success": True, "total_tokens": total_tokens}
-    except Exception as e:
-        print(f"Error counting tokens: {e}")
-        return {"success": False, "message": str(e)}
+    return await count_tokens_local(message)
 
 
 @router.post("/api/count-tokens")
@@ -141,3 +360,30 @@ async def count_tokens(message: TokenMessage):
         return await count_tokens_openai(message)
     elif settings["api_type"] == "googleaistudio":
         return await count_tokens_googleaistudio(message)
+
+
+@router.post("/api/count-tokens/batch")
+async def count_tokens_batch(message: TokenBatchMessage):
+    """Count many entries in one request, and the system prompt if asked."""
+    try:
+        settings = load_settings()
+        system_token_count = None
+        if settings["api_type"] == "infermaticai":
+            api_settings = load_api_settings()
+            prompts = [make_prompt_single("Julien", entry) for entry in message.entries]
+            if message.system_prompt and message.first_entry is not None:
+                prompts.append(make_system_prompt_infermaticai(message.info, message.first_entry))
+            counts = await count_texts_infermaticai(prompts, api_settings)
+            if message.system_prompt and message.first_entry is not None:
+                system_token_count = counts.pop()
+        else:
+            texts = [entry.content for entry in message.entries]
+            system_texts = make_system_prompt_texts(message.info) if message.system_prompt else []
+            counts = await asyncio.to_thread(count_texts_local, texts + system_texts)
+            if message.system_prompt:
+                system_token_count = sum(counts[len(texts) :])
+                counts = counts[: len(texts)]
+        return {"success": True, "token_counts": counts, "system_token_count": system_token_count}
+    except Exception as e:
+        print(f"Error counting tokens: {e}")
+        return {"success": False, "message": str(e)}
@@ -0,0 +1,119 @@
+import asyncio
+import hashlib
+import os
+import tempfile
+from fastapi import HTTPException, Request
+from starlette.datastructures import UploadFile
+from settings import get_data_path
+
+# Largest accepted upload, the largest images and cards are a few tens of MB
+MAX_UPLOAD_SIZE = 64 * 1024 * 1024
+# Received data is written to disk once this much is buffered
+WRITE_BLOCK_SIZE = 1024 * 1024
+# Multipart bodies may be this much larger than MAX_UPLOAD_SIZE, for boundaries and other fields
+MAX_FORM_OVERHEAD = 1024 * 1024
+
+
+def resolve_data_path(path: str) -> str:
+    """Absolute path of a path relative to the data directory, refusing paths outside of it."""
+    base_path = os.path.normpath(get_data_path())
+    full_path = os.path.normpath(os.path.join(base_path, path.lstrip("/")))
+    if os.path.commonpath([base_path]) != os.path.commonpath([base_path, full_path]):
+        raise HTTPException(status_code=400, detail="Invalid path - must be under /data directory")
+    return full_path
+
+
+def check_content_length(request: Request):
+    """Refuse an upload announced as too large before reading its body."""
+    length = request.headers.get("content-length")
+    if length is not None and length.isdigit() and int(length) > MAX_UPLOAD_SIZE:
+        raise HTTPException(status_code=413, detail=f"Upload larger than {MAX_UPLOAD_SIZE} bytes")
+
+
+def limit_body(request: Request, limit: int) -> Request:
+    """The request with its body refused with 413 once more than limit bytes arrive.
+
+    Counts what is received, so bodies sent without a Content-Length, like
+    chunked uploads, are capped too.
+    """
+    receive = request.receive
+    received = 0
+
+    async def limited_receive():
+        nonlocal received
+        message = await receive()
+        if message["type"] == "http.request":
+            received += len(message.get("body", b""))
+            if received > limit:
+                raise HTTPException(status_code=413, detail=f"Upload larger than {MAX_UPLOAD_SIZE} bytes")
+        return message
+
+    return Request(request.scope, limited_receive)
+
+
+async def read_form(request: Request):
+    """Parse a multipart upload, refusing it with 413 while it is received if it is too large."""
+    check_content_length(request)
+    # The multipart parser spools file parts to a temporary file, not to memory
+    return await limit_body(request, MAX_UPLOAD_SIZE + MAX_FORM_OVERHEAD).form(max_files=1)
+
+
+async def upload_chunks(request: Request):
+    """Chunks of the uploaded file: the "file" part of a multipart body, or else the raw body."""
+    if request.headers.get("content-type", "").startswith("multipart/form-data"):
+        form = await read_form(request)
+        try:
+            upload = form.get("file")
+            if not isinstance(upload, UploadFile):
+                raise HTTPException(status_code=400, detail='Multipart upload needs a "file" part')
+            while chunk := await upload.read(WRITE_BLOCK_SIZE):
+                yield chunk
+        finally:
+            await form.close()
+    else:
+        async for chunk in request.stream():
+            yield chunk
+
+
+def hash_file(f) -> dict:
+    """Size and sha256 of a file object, read from its start and rewound."""
+    digest = hashlib.sha256()
+    size = 0
+    f.seek(0)
+    while block := f.read(WRITE_BLOCK_SIZE):
+        size += len(block)
+        digest.update(block)
+    f.seek(0)
+    return {"size": size, "sha256": digest.hexdigest()}
+
+
+async def save_upload(request: Request, full_path: str) -> dict:
+    """Stream an upload to full_path, replacing the file atomically once it is complete.
+
+    Returns its size and sha256, so clients can tell identical uploads apart.
+    Uploads over MAX_UPLOAD_SIZE are refused with 413 and leave no file.
+    """
+    check_content_length(request)
+    directory = os.path.dirname(full_path)
+    os.makedirs(directory, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=directory, prefix=".upload-", suffix=".tmp")
+    digest = hashlib.sha256()
+    size = 0
+    try:
+        with os.fdopen(fd, "wb") as f:
+            buffer = bytearray()
+            async for chunk in upload_chunks(request):
+                size += len(chunk)
+                if size > MAX_UPLOAD_SIZE:
+                    raise HTTPException(status_code=413, detail=f"Upload larger than {MAX_UPLOAD_SIZE} bytes")
+                digest.update(chunk)
+                buffer += chunk
+                if len(buffer) >= WRITE_BLOCK_SIZE:
+                    await asyncio.to_thread(f.write, bytes(buffer))
+                    buffer.clear()
+            await asyncio.to_thread(f.write, bytes(buffer))
+        os.replace(tmp_path, full_path)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+    return {"size": size, "sha256": digest.hexdigest()}
@@ -27,12 +27,32 @@ export async function get_checkpoints(): Promise<string[]> {
   }
 }
 
+// Sessions fetched per request when listing a character's sessions
+const SESSION_PAGE_SIZE = 200
+
 export async function get_session_entries(char_name: string): Promise<string[]> {
   try {
-    const path = `../data/sessions/${char_name}`
-    const entries = await get_dir_entries(path)
-    const sessions = entries.entries.map((entry: Entry) => entry.name)
-    return sessions
+    // Most recently updated first, from the server's session index
+    const session_names: string[] = []
+    let total = Infinity
+    while (session_names.length < total) {
+      const params = new URLSearchParams({
+        character: char_name,
+        offset: String(session_names.length),
+        limit: String(SESSION_PAGE_SIZE),
+      })
+      const response = await fetch(`http://localhost:5000/api/sessions?${params}`)
+      if (!response.ok) {
+        throw new Error('Failed to fetch sessions')
+      }
+      const data = await response.json()
+      if (data.sessions.length === 0) {
+        break
+      }
+      session_names.push(...data.sessions.map((session: { session_name: string }) => session.session_name))
+      total = data.total
+    }
+    return session_names
   } catch (error) {
     console.error('Error fetching session entries:', error)
     return []
@@ -41,16 +61,22 @@ export async function get_session_entries(char_name: string): Promise<string[]>
 
 export async function get_session_json(char_name: string, session_name: string): Promise<any> {
   try {
-    const response = await fetch(
-      `http://localhost:5000/data/sessions/${char_name}/${session_name}/session.json`
-    )
+    // The session is stored as a snapshot and a journal, the server replays them
+    const response = await fetch('http://localhost:5000/api/load-session', {
+      method: 'POST',
+      headers: {
+        'Content-Type': 'application/json',
+      },
+      body: JSON.stringify({ name: char_name, session_name: session_name }),
+    })
     if (!response.ok) {
-      console.error('Failed to fetch session.json:', response.statusText)
+      console.error('Failed to load session:', response.statusText)
       return null
     }
-    return await response.json()
+    const data = await response.json()
+    return data.success ? data.session : null
   } catch (error) {
-    console.error('Error fetching session.json:', error)
+    console.error('Error loading session:', error)
     return null
   }
 }
@@ -120,47 +146,40 @@ export async function save_json(path: string, json_data: any): Promise<boolean>
   }
 }
 
-export async function save_image(dir: string, image_name: string, image: Uint8Array | string) {
-  if (typeof image === 'string' && image.startsWith('data:image/png;base64,')) {
-    // image exists but not saved yet
-    try {
-      const response = await fetch('http://localhost:5000/api/save-image', {
-        method: 'POST',
-        headers: {
-          'Content-Type': 'application/json',
-        },
-        body: JSON.stringify({
-          path: `${dir}/${image_name}.png`,
-          image: image,
-        }),
-      })
+// Blob of a data URL, sent as a binary body instead of base64 in JSON
+export async function data_url_to_blob(url: string): Promise<Blob> {
+  const response = await fetch(url)
+  return await response.blob()
+}
 
-      if (response.ok) {
-        const data = await response.json()
-        return `http://localhost:5000/data/${data.path}` // Clear the base64 image data after saving
-      }
-    } catch (error) {
-      console.error('Error saving image:', error)
-    }
-  } else {
-    try {
-      const response = await fetch('http://localhost:5000/api/save-binary', {
-        method: 'POST',
-        headers: {
-          'Content-Type': 'application/json',
-        },
-        body: JSON.stringify({
-          path: `${dir}/${image_name}.png`,
-          image: image,
-        }),
-      })
-      if (response.ok) {
-        const data = await response.json()
-        return `http://localhost:5000/data/${data.path}`
-      }
-    } catch (error) {
-      console.error('Error saving image binary:', error)
+// Stores the body as a file under /data, returns its versioned path or null
+export async function upload_file(path: string, body: Blob | Uint8Array): Promise<string | null> {
+  const params = new URLSearchParams({ path: path })
+  const response = await fetch(`http://localhost:5000/api/upload?${params}`, {
+    method: 'POST',
+    headers: {
+      'Content-Type': 'application/octet-stream',
+    },
+    body: body,
+  })
+  if (!response.ok) {
+    console.error('Failed to upload file:', response.statusText)
+    return null
+  }
+  const data = await response.json()
+  return data.url
+}
+
+export async function save_image(dir: string, image_name: string, image: Uint8Array | string) {
+  try {
+    // A string image exists but is not saved yet
+    const body = typeof image === 'string' ? await data_url_to_blob(image) : image
+    const path = await upload_file(`${dir}/${image_name}.png`, body)
+    if (path) {
+      return `http://localhost:5000/data/${path}`
     }
+  } catch (error) {
+    console.error('Error saving image:', error)
   }
   return ''
 }
@@ -175,20 +194,12 @@ export async function save_image_story_entry(
     if (image.image && image.image.startsWith('data:image/png;base64,')) {
       // image exists but not saved yet
       try {
-        const response = await fetch('http://localhost:5000/api/save-image', {
-          method: 'POST',
-          headers: {
-            'Content-Type': 'application/json',
-          },
-          body: JSON.stringify({
-            path: `${dir}/${image_name}_${i}.png`,
-            image: image.image,
-          }),
-        })
-
-        if (response.ok) {
-          const data = await response.json()
-          entry.images[i].image = `http://localhost:5000/data/${data.path}` // Clear the base64 image data after saving
+        const path = await upload_file(
+          `${dir}/${image_name}_${i}.png`,
+          await data_url_to_blob(image.image)
+        )
+        if (path) {
+          entry.images[i].image = `http://localhost:5000/data/${path}` // Clear the base64 image data after saving
         }
       } catch (error) {
         console.error('Error saving image:', error)
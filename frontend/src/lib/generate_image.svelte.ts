@@ -28,7 +28,8 @@ async function generate_image(
     }),
   })
   const data = await response.json()
-  const image = data.image
+  // The image is saved on the server and served from /data
+  const image = `http://localhost:5000/data/${data.path}`
   return image
 }
 
@@ -0,0 +1,81 @@
+import type { Session } from '../types/session'
+import type { ImageEntry, StoryEntry } from '../types/story'
+
+export type SessionOp =
+  | { op: 'append'; entry: StoryEntry }
+  | {
+      op: 'edit'
+      id: number
+      speaker?: string
+      content?: string
+      state?: string
+      token_count?: number
+    }
+  | { op: 'delete'; ids: number[] }
+  | { op: 'add_image'; id: number; image: ImageEntry }
+  | { op: 'set_active_image'; id: number; active_image: number | null }
+
+// Session held by the server, updated with deltas
+export const session_ref = { id: '', version: 0 }
+
+export async function open_session(
+  character: string,
+  session_name: string,
+  session?: Session
+): Promise<boolean> {
+  try {
+    const response = await fetch('http://localhost:5000/api/session/open', {
+      method: 'POST',
+      headers: {
+        'Content-Type': 'application/json',
+      },
+      body: JSON.stringify({ character, session_name, session }),
+    })
+    const data = await response.json()
+    if (!data.success) return false
+    session_ref.id = data.session_id
+    session_ref.version = data.version
+    return true
+  } catch (e) {
+    console.error('Failed to open session:', e)
+    return false
+  }
+}
+
+// Apply ops to the server-held session. When there is none yet or the server copy
+// is out of date, it is replaced by the full session from `current`, which already
+// includes the ops.
+export async function send_delta(
+  ops: SessionOp[],
+  current: () => Session,
+  system_token_count?: number
+): Promise<boolean> {
+  if (!session_ref.id) return await upload_session(current())
+  try {
+    const response = await fetch('http://localhost:5000/api/session/delta', {
+      method: 'POST',
+      headers: {
+        'Content-Type': 'application/json',
+      },
+      body: JSON.stringify({
+        session_id: session_ref.id,
+        version: session_ref.version,
+        ops,
+        system_token_count,
+      }),
+    })
+    if (response.ok) {
+      session_ref.version = (await response.json()).version
+      return true
+    }
+    console.warn('Session delta refused, uploading the full session:', response.statusText)
+  } catch (e) {
+    console.error('Failed to update session:', e)
+  }
+  return await upload_session(current())
+}
+
+async function upload_session(session: Session): Promise<boolean> {
+  const character = session.selected_char.file_name.replace('.card', '')
+  return await open_session(character, session.session_name, session)
+}
@@ -1,24 +1,42 @@
 import { tick } from 'svelte'
 
 export type ReceivedData =
-  | { text: string; reset?: never; start_index?: never }
-  | { reset: boolean; text?: never; start_index?: never }
-  | { start_index: number; text?: never; reset?: never }
+  | { text: string; reset?: never; thought?: never; start_index?: never }
+  | { reset: boolean; text?: never; thought?: never; start_index?: never }
+  | { thought: string; text?: never; reset?: never; start_index?: never }
+  | {
+      start_index: number
+      prefix_stable?: boolean
+      token_count?: number | null
+      usage_tokens?: number
+      text?: never
+      reset?: never
+      thought?: never
+    }
 
 export async function send_stream(
   url: string,
   payload: any,
   received: (data: ReceivedData) => void,
-  start_receive?: () => void
+  start_receive?: () => void,
+  signal?: AbortSignal
 ): Promise<string> {
   let error = ''
-  const response = await fetch('http://localhost:5000/api/' + url, {
-    method: 'POST',
-    headers: {
-      'Content-Type': 'application/json',
-    },
-    body: JSON.stringify(payload),
-  })
+  let response: Response
+  try {
+    response = await fetch('http://localhost:5000/api/' + url, {
+      method: 'POST',
+      headers: {
+        'Content-Type': 'application/json',
+      },
+      body: JSON.stringify(payload),
+      signal,
+    })
+  } catch (e) {
+    // Aborting closes the connection, which cancels the upstream request on the server
+    if (signal?.aborted) return ''
+    throw e
+  }
 
   if (!response.ok) {
     console.log(response)
@@ -34,7 +52,14 @@ export async function send_stream(
   if (start_receive) start_receive()
 
   while (true) {
-    const { value, done } = await reader.read()
+    let value: Uint8Array | undefined
+    let done: boolean
+    try {
+      ;({ value, done } = await reader.read())
+    } catch (e) {
+      if (signal?.aborted) break
+      throw e
+    }
 
     if (done) break
 
@@ -1,6 +1,8 @@
 export interface Character {
   file_name: string
   image: string
+  // Scaled down card image, listed characters only
+  thumbnail?: string | null
   info: {
     name: string
     description: string
@@ -22,6 +22,8 @@ export interface StoryEntry {
   images: ImageEntry[]
   active_image?: number
   token_count?: number
+  // Thoughts streamed by thinking models, shown with the reply but never sent back
+  thought?: string
 }
 
 export type StoryEntries = StoryEntry[]